@@ -0,0 +1,131 @@
+import argparse
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sweep import ENGINES
+
+# Same defaults as run_model: network_density=100 with both extensions on, plus the variants without them
+MATRIX = {"engine": ["mesa", "vectorized"],
+          "num_hh": [100, 1000, 10000, 100000],
+          "num_cmp": [10, 100],
+          "network_density": [5, 100],
+          "extensions": [(True, True), (True, False), (False, True), (False, False)]}
+QUICK_MATRIX = {"engine": ["mesa", "vectorized"],
+                "num_hh": [100, 1000],
+                "num_cmp": [10],
+                "network_density": [5],
+                "extensions": [(True, True), (False, False)]}
+
+
+def make_cases(matrix):
+    names = list(matrix)
+    cases = []
+    for values in itertools.product(*(matrix[name] for name in names)):
+        case = dict(zip(names, values))
+        # the Barabasi-Albert network needs network_density < num_hh
+        if case["network_density"] >= case["num_hh"]:
+            continue
+        case["use_marketing"], case["use_network"] = case.pop("extensions")
+        cases.append(case)
+    return cases
+
+
+# Runs in a fresh process so that the peak RSS belongs to this case only
+def run_case(case, days, seed):
+    run_model = importlib.import_module(ENGINES[case["engine"]]).run_model
+    start = time.perf_counter()
+    abm_model = run_model(case["num_hh"], case["num_cmp"], 0, network_density=case["network_density"],
+                          use_marketing=case["use_marketing"], use_network=case["use_network"], seed=seed,
+                          progress=None)
+    setup = time.perf_counter() - start
+    daily, month_end = [], []
+    for _ in range(days):
+        month = abm_model.current_day % 10 == 0
+        start = time.perf_counter()
+        abm_model.step()
+        (month_end if month else daily).append(time.perf_counter() - start)
+    total = sum(daily) + sum(month_end)
+    result = dict(case)
+    result.update({"days": days,
+                   "setup_seconds": setup,
+                   "days_per_second": days / total,
+                   "daily_step_seconds": float(np.mean(daily)) if daily else float("nan"),
+                   "month_end_step_seconds": float(np.mean(month_end)) if month_end else float("nan"),
+                   "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+    return result
+
+
+def code_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmark(matrix=None, days=100, seed=0, output=None, verbose=True):
+    cases = make_cases(matrix or MATRIX)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, case, days, seed).result()
+        results.append(result)
+        if verbose:
+            print(json.dumps(result), flush=True)
+    report = {"version": code_version(),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "machine": platform.platform(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "results": results}
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+# Days/sec of the new report relative to the old one for every case present in both
+def compare(old_report, new_report):
+    keys = ["engine", "num_hh", "num_cmp", "network_density", "use_marketing", "use_network"]
+    old = pd.DataFrame(old_report["results"]).set_index(keys)
+    new = pd.DataFrame(new_report["results"]).set_index(keys)
+    table = old[["days_per_second"]].join(new[["days_per_second"]], lsuffix="_old", rsuffix="_new", how="inner")
+    table["speedup"] = table["days_per_second_new"] / table["days_per_second_old"]
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure step throughput of the models across sizes and extensions.")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--days", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="small matrix for a fast check")
+    parser.add_argument("--engine", choices=sorted(ENGINES), action="append", help="only these engines")
+    parser.add_argument("--max-households", type=int, default=None)
+    parser.add_argument("--compare", metavar="OLD_JSON", help="print the speedup against an earlier report")
+    args = parser.parse_args()
+
+    matrix = dict(QUICK_MATRIX if args.quick else MATRIX)
+    if args.engine:
+        matrix["engine"] = args.engine
+    if args.max_households:
+        matrix["num_hh"] = [n for n in matrix["num_hh"] if n <= args.max_households]
+    report = run_benchmark(matrix, args.days, args.seed, args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report).to_string())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import numpy as np
+from recorder import ArrayRecorder
+from sweep import ENGINES
+
+# modules whose source is part of every cache key, so that changing the model invalidates old runs
+SOURCES = ("model.py", "vectorized.py", "partitioned.py", "utils.py", "recorder.py", "convergence.py", "network.py")
+# run_model arguments that do not change the collected data
+IGNORED = ("model_cls", "record_path", "record_chunk", "record_format", "progress", "profile", "recorder",
+           "network_cache")
+
+
+def code_version():
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        with open(os.path.join(directory, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+# Result of a cached run: the collected data and the few model attributes needed to read it
+class CachedRun:
+    def __init__(self, datacollector, metadata):
+        self.datacollector = datacollector
+        self.metadata = metadata
+        self.num_hh = metadata["number_of_households"]
+        self.num_cmp = metadata["number_of_companies"]
+        self.current_day = metadata["current_day"]
+        self.converged_day = metadata["converged_day"]
+
+
+# Content-addressed store of completed runs. An entry is a compressed .npz with the arrays collected
+# by the run, named by the hash of the engine, every run_model argument (which determine
+# HouseholdParameters and CompanyParameters), the seed and the model source code. When the files
+# exceed max_bytes the least recently used entries are removed.
+class RunCache:
+    def __init__(self, path="run_cache", max_bytes=2 * 1024 ** 3):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = code_version()
+
+    def key(self, engine, arguments):
+        description = {"engine": engine, "version": self.version, "arguments": arguments}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=repr).encode()).hexdigest()
+
+    def entry_file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def get(self, key):
+        entry = self.entry_file(key)
+        try:
+            with np.load(entry) as data:
+                arrays = {name: data[name] for name in data.files if name != "__metadata__"}
+                metadata = json.loads(str(data["__metadata__"]))
+        except FileNotFoundError:
+            return None
+        os.utime(entry)  # mark as recently used
+        recorder = ArrayRecorder()
+        recorder.set_arrays(arrays)
+        return CachedRun(recorder, metadata)
+
+    def put(self, key, abm_model, metadata):
+        recorder = abm_model.datacollector
+        arrays = {name: recorder.get_array(name) for name in recorder.shapes or ()}
+        metadata = dict(metadata, current_day=abm_model.current_day,
+                        converged_day=getattr(abm_model.convergence, "converged_day", None))
+        # written under a temporary name so that concurrent readers never see a partial entry
+        temporary = os.path.join(self.path, f"{key}.{os.getpid()}.tmp.npz")
+        np.savez_compressed(temporary, __metadata__=json.dumps(metadata, default=repr), **arrays)
+        os.replace(temporary, self.entry_file(key))
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".npz") and ".tmp." not in name:
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name[:-4]))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.invalidate(key)
+            total -= size
+
+    def invalidate(self, key):
+        try:
+            os.remove(self.entry_file(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.invalidate(key)
+
+    # Same arguments as run_model. Returns a CachedRun on a hit, otherwise runs the model, stores its
+    # data and returns the model. Runs without a seed are not reproducible and are never cached.
+    def run_model(self, number_of_households, number_of_companies, number_of_steps, engine="mesa", **kwargs):
+        engine_run_model = importlib.import_module(ENGINES[engine]).run_model
+        # only the arrays of an ArrayRecorder can be stored; other recorders stream their data elsewhere
+        recorder = kwargs.get("recorder")
+        if kwargs.get("seed") is None or not (recorder is None or isinstance(recorder, ArrayRecorder)):
+            return engine_run_model(number_of_households, number_of_companies, number_of_steps, **kwargs)
+        # bound against the engine's own run_model, so that its extra arguments (e.g. shards) are in the key
+        arguments = inspect.signature(engine_run_model).bind(number_of_households, number_of_companies,
+                                                             number_of_steps, **kwargs)
+        arguments.apply_defaults()
+        arguments = {name: value for name, value in arguments.arguments.items() if name not in IGNORED}
+        key = self.key(engine, arguments)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        abm_model = engine_run_model(number_of_households, number_of_companies, number_of_steps, **kwargs)
+        self.put(key, abm_model, {"engine": engine, "key": key, **arguments})
+        return abm_model
@@ -0,0 +1,39 @@
+import pickle
+import random
+import numpy as np
+from model import scheduler_seed
+
+# Checkpoints of LenExtended / LenVectorized. LenExtended agents draw from the global random and
+# np.random generators, so their states are stored next to the model to continue the run exactly as
+# if it had never been interrupted. LenVectorized keeps its generator and is pickled with it.
+
+
+def save_checkpoint(abm_model, path):
+    state = {"model": abm_model,
+             "random": random.getstate(),
+             "np_random": np.random.get_state()}
+    with open(path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# Restore a model saved with save_checkpoint. To branch several runs from one warmed-up snapshot pass
+# a different seed to each branch, parameters to change (see LenExtended.set_parameters) and, if the
+# model writes collected data to disk, a new record_path so that branches do not share files.
+def load_checkpoint(path, seed=None, record_path=None, **parameters):
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    abm_model = state["model"]
+    random.setstate(state["random"])
+    np.random.set_state(state["np_random"])
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        if hasattr(abm_model, "random"):
+            abm_model.random.seed(scheduler_seed(seed))
+        if hasattr(abm_model, "reseed"):
+            abm_model.reseed(seed)
+    if parameters:
+        abm_model.set_parameters(**parameters)
+    if record_path is not None:
+        abm_model.datacollector.move_to(record_path)
+    return abm_model
@@ -0,0 +1,98 @@
+import argparse
+import importlib
+import inspect
+import json
+import sys
+import time
+from model import run_model, PROGRESS
+from recorder import StreamRecorder
+from sweep import ENGINES, parse_value
+
+# run_model arguments that are not exposed as options: the recorder is always a StreamRecorder
+SKIPPED = ("model_cls", "record_path", "record_chunk", "record_format", "progress", "recorder")
+
+
+def parse_bool(value):
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise argparse.ArgumentTypeError(f"expected true or false, got {value}")
+
+
+# ints where the default is an int, but e.g. --demand-max 1.5 is still accepted
+def parse_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+# One option per keyword argument of run_model, typed after its default value, plus the arguments
+# that engines add to it (e.g. --shards of the partitioned engine)
+def add_model_options(parser):
+    group = parser.add_argument_group("model parameters (see run_model)")
+    parameters = dict(inspect.signature(run_model).parameters)
+    for module in ENGINES.values():
+        for name, parameter in inspect.signature(importlib.import_module(module).run_model).parameters.items():
+            parameters.setdefault(name, parameter)
+    for name, parameter in parameters.items():
+        if parameter.default is inspect.Parameter.empty or name in SKIPPED:
+            continue
+        default = parameter.default
+        if isinstance(default, bool):
+            kind = parse_bool
+        elif isinstance(default, int):
+            kind = parse_number
+        elif isinstance(default, float):
+            kind = float
+        else:
+            kind = parse_value
+        group.add_argument("--" + name.replace("_", "-"), dest=name, type=kind, default=argparse.SUPPRESS,
+                           help=f"default: {default}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the model without a notebook and stream the monthly "
+                                                 "aggregates to a JSONL, CSV or Parquet file.")
+    parser.add_argument("output", help="file the monthly aggregates are written to (.jsonl, .csv or .parquet)")
+    parser.add_argument("--config", help="JSON file with run_model parameters, overridden by options")
+    parser.add_argument("--households", type=int, default=argparse.SUPPRESS, help="default: 150")
+    parser.add_argument("--companies", type=int, default=argparse.SUPPRESS, help="default: 10")
+    parser.add_argument("--days", type=int, default=argparse.SUPPRESS, help="default: 20000")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default=argparse.SUPPRESS, help="default: mesa")
+    parser.add_argument("--format", choices=["jsonl", "csv", "parquet"], default=None,
+                        help="output format, by default taken from the file extension")
+    parser.add_argument("--progress", choices=["tqdm", "none"], default="none")
+    add_model_options(parser)
+    args = vars(parser.parse_args(argv))
+
+    parameters = {"households": 150, "companies": 10, "days": 20000, "engine": "mesa"}
+    if args["config"] is not None:
+        with open(args["config"]) as f:
+            parameters.update(json.load(f))
+    output, file_format, progress = args.pop("output"), args.pop("format"), args.pop("progress")
+    del args["config"]
+    parameters.update(args)
+
+    engine = parameters.pop("engine")
+    if engine not in ENGINES:
+        parser.error(f"unknown engine: {engine}")
+    households, companies, days = parameters.pop("households"), parameters.pop("companies"), parameters.pop("days")
+    engine_run_model = importlib.import_module(ENGINES[engine]).run_model
+    unknown = sorted(set(parameters) - set(inspect.signature(engine_run_model).parameters))
+    if unknown:
+        parser.error(f"the {engine} engine does not take: {', '.join(unknown)}")
+    recorder = StreamRecorder(output, file_format)
+    start = time.time()
+    try:
+        abm_model = engine_run_model(households, companies, days, progress=PROGRESS[progress], recorder=recorder,
+                                     **parameters)
+    finally:
+        recorder.close()
+    print(f"{abm_model.current_day} days, {len(recorder)} months written to {output} "
+          f"in {time.time() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from collections import deque
+import numpy as np
+from recorder import aggregate_state
+
+# monthly aggregates (see recorder.AGGREGATES) watched by ConvergenceMonitor
+SERIES = ("price", "employment", "total_hh_wealth", "inventory")
+
+
+# Detects the stationary regime of a run from the aggregates of every collected month. The mean of
+# each series over the last `window` months is compared with its mean over the `window` months
+# before (see relative_change); once every relative change stays below `tolerance` for `patience` months in a row the run
+# has converged. Then the model either stops (action="stop") or keeps running and collects only
+# every `sparse_every`-th month (action="sparse").
+class ConvergenceMonitor:
+    def __init__(self, window=100, tolerance=0.05, patience=20, series=SERIES, action="stop", sparse_every=10,
+                 min_day=0):
+        if action not in ("stop", "sparse"):
+            raise ValueError(f'Unknown action: {action}')
+        self.window = window
+        self.tolerance = tolerance
+        self.patience = patience
+        self.series = tuple(series)
+        self.action = action
+        self.sparse_every = sparse_every
+        self.min_day = min_day  # no convergence before this day
+        self.history = {name: deque(maxlen=2 * window) for name in self.series}
+        self.changes = {}  # last relative change of every series
+        self.months = 0
+        self.streak = 0  # months in a row the criterion held
+        self.converged_day = None
+
+    # Change of the window mean relative to its level, or to the spread of the series if that is
+    # larger, so that noisy series close to zero (e.g. inventory) do not look unstable
+    def relative_change(self, values):
+        values = np.asarray(values)
+        previous = values[:self.window].mean()
+        last = values[self.window:].mean()
+        scale = max(abs(previous), abs(last), values.std())
+        return float(abs(last - previous) / scale) if scale > 0 else 0.
+
+    def update(self, model, state):
+        aggregates = aggregate_state(state)
+        self.months += 1
+        for name in self.series:
+            self.history[name].append(aggregates[name])
+        if self.months < 2 * self.window:
+            return
+        self.changes = {name: self.relative_change(values) for name, values in self.history.items()}
+        if all(change < self.tolerance for change in self.changes.values()):
+            self.streak += 1
+        else:
+            self.streak = 0
+        if self.streak >= self.patience and model.current_day >= self.min_day:
+            self.converged_day = model.current_day
+            if self.action == "stop":
+                model.running = False
+
+    # Called by the model instead of datacollector.collect on every month-end day
+    def collect(self, model):
+        if self.converged_day is None:
+            self.update(model, model.datacollector.collect(model))
+        elif (model.current_day - self.converged_day) % (10 * self.sparse_every) == 0:
+            model.datacollector.collect(model)
+
+    # Day of every row collected so far, rows after convergence are sparse
+    def record_days(self, number_of_records):
+        days = []
+        for row in range(number_of_records):
+            if self.converged_day is None or row <= self.converged_day // 10:
+                days.append(row * 10)
+            else:
+                days.append(self.converged_day + (row - self.converged_day // 10) * 10 * self.sparse_every)
+        return days
+
+    def diagnostics(self):
+        result = {"converged": self.converged_day is not None,
+                  "converged_day": self.converged_day,
+                  "stop_day": self.converged_day if self.action == "stop" else None,
+                  "months_monitored": self.months}
+        for name in self.series:
+            result["change_" + name] = self.changes.get(name)
+        return result
+
+
+# run_model accepts a monitor, True for the defaults or a dict of ConvergenceMonitor arguments
+def make_monitor(convergence):
+    if convergence is None or convergence is False:
+        return None
+    if convergence is True:
+        return ConvergenceMonitor()
+    if isinstance(convergence, dict):
+        return ConvergenceMonitor(**convergence)
+    return convergence
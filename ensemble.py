@@ -0,0 +1,186 @@
+import argparse
+import ctypes
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from recorder import aggregate_state
+from sweep import ENGINES, make_runs, parse_value
+
+# monthly aggregates (see recorder.AGGREGATES) summarized across replicas
+METRICS = ("price", "hh_wage", "hh_wealth", "employment")
+QUANTILES = (0.05, 0.5, 0.95)
+# replicas below which quantiles are NaN: the outer P² markers need many more than the first five
+# observations to move away from the extremes (with 30 normal replicas the 5% and 95% estimates are
+# off by about 0.15 standard deviations on average, with 10 by 0.7)
+MIN_QUANTILE_REPLICAS = 30
+
+
+# P² estimate of one quantile (Jain & Chlamtac, 1985) kept in 10 floats: marker heights and
+# positions. The first five observations are stored as they come and sorted on the fifth.
+def p2_update(heights, positions, count, p, x):
+    if count < 5:
+        heights[count] = x
+        if count == 4:
+            heights.sort()
+            positions[:] = np.arange(1, 6)
+        return
+    if x < heights[0]:
+        heights[0] = x
+        k = 0
+    elif x >= heights[4]:
+        heights[4] = x
+        k = 3
+    else:
+        k = int(np.searchsorted(heights, x, side="right")) - 1
+    positions[k + 1:] += 1
+    # desired positions after count + 1 observations
+    desired = 1 + count * np.array([0, p / 2, p, (1 + p) / 2, 1])
+    q, n = heights, positions
+    for i in (1, 2, 3):
+        d = desired[i] - n[i]
+        if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+            d = 1. if d > 0 else -1.
+            right = (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            left = (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+            parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (right + left)
+            if q[i - 1] < parabolic < q[i + 1]:
+                q[i] = parabolic
+            else:
+                j = i + int(d)
+                q[i] = q[i] + d * (q[j] - q[i]) / (n[j] - n[i])
+            n[i] += d
+
+
+def p2_quantile(heights, count):
+    if count < MIN_QUANTILE_REPLICAS:
+        return np.nan
+    return float(heights[2])
+
+
+# Streaming summary of every (month, metric) across replicas: Welford count / mean / M2 and one P²
+# sketch per quantile, stored in a flat float64 buffer that can live in shared memory. Its size
+# depends on the number of months only, not on the number of replicas.
+class EnsembleAccumulator:
+    def __init__(self, number_of_months, metrics=METRICS, quantiles=QUANTILES, buffer=None):
+        self.metrics = tuple(metrics)
+        self.quantiles = tuple(quantiles)
+        shape = (number_of_months, len(self.metrics), 3 + 10 * len(self.quantiles))
+        if buffer is None:
+            self.state = np.zeros(shape)
+        else:
+            self.state = np.frombuffer(buffer, dtype=np.float64).reshape(shape)
+
+    def update(self, month, aggregates):
+        if month >= len(self.state):
+            return
+        for metric, cell in zip(self.metrics, self.state[month]):
+            x = aggregates[metric]
+            count = int(cell[0])
+            delta = x - cell[1]
+            cell[1] += delta / (count + 1)
+            cell[2] += delta * (x - cell[1])
+            for j, p in enumerate(self.quantiles):
+                sketch = cell[3 + 10 * j:13 + 10 * j]
+                p2_update(sketch[:5], sketch[5:], count, p, x)
+            cell[0] = count + 1
+
+    def summary(self, days_per_month=10):
+        rows = []
+        for month, cells in enumerate(self.state):
+            row = {"day": month * days_per_month, "replications": int(cells[0, 0])}
+            for metric, cell in zip(self.metrics, cells):
+                count = int(cell[0])
+                row[metric + "_mean"] = cell[1] if count else np.nan
+                row[metric + "_var"] = cell[2] / (count - 1) if count > 1 else np.nan
+                for j, p in enumerate(self.quantiles):
+                    row[f"{metric}_q{p:g}"] = p2_quantile(cell[3 + 10 * j:8 + 10 * j], count)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+# Recorder of a replica: pushes the aggregates of every collected month into the shared accumulator
+class EnsembleRecorder:
+    def __init__(self, accumulator, lock):
+        self.accumulator = accumulator
+        self.lock = lock
+
+    def collect(self, model):
+        state = model.record_state()
+        aggregates = aggregate_state(state)
+        with self.lock:
+            self.accumulator.update(model.current_day // 10, aggregates)
+        return state
+
+    def flush(self):
+        pass
+
+
+# accumulator and lock of a worker process, set by attach
+worker_accumulator = None
+worker_lock = None
+
+
+def attach(buffer, lock, number_of_months, metrics, quantiles):
+    global worker_accumulator, worker_lock
+    worker_accumulator = EnsembleAccumulator(number_of_months, metrics, quantiles, buffer)
+    worker_lock = lock
+
+
+def run_replica(engine, number_of_households, number_of_companies, number_of_steps, parameters, seed):
+    run_model = importlib.import_module(ENGINES[engine]).run_model
+    run_model(number_of_households, number_of_companies, number_of_steps, seed=seed, progress=None,
+              recorder=EnsembleRecorder(worker_accumulator, worker_lock), **parameters)
+    return seed
+
+
+# Runs `replications` seeded replicas of one configuration in worker processes and returns the
+# per-month mean, variance and quantiles of METRICS across them as one DataFrame. Quantiles are P²
+# estimates, NaN for months with fewer than MIN_QUANTILE_REPLICAS replicas; they depend slightly on
+# the order in which replicas report.
+def run_ensemble(number_of_households, number_of_companies, number_of_steps, replications, seed=0, engine="mesa",
+                 workers=None, metrics=METRICS, quantiles=QUANTILES, progress=True, **parameters):
+    number_of_months = (number_of_steps + 9) // 10
+    context = multiprocessing.get_context()
+    size = number_of_months * len(metrics) * (3 + 10 * len(quantiles))
+    buffer = context.RawArray(ctypes.c_double, size)
+    lock = context.Lock()
+    accumulator = EnsembleAccumulator(number_of_months, metrics, quantiles, buffer)
+    runs = make_runs({}, replications, seed)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=attach,
+                             initargs=(buffer, lock, number_of_months, metrics, quantiles)) as executor:
+        futures = [executor.submit(run_replica, engine, number_of_households, number_of_companies, number_of_steps,
+                                   parameters, run["seed"]) for run in runs]
+        for future in tqdm(as_completed(futures), total=len(futures), disable=not progress):
+            future.result()
+    return accumulator.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run replicas of one configuration in a process pool and write "
+                                                 "per-month ensemble statistics.")
+    parser.add_argument("output", help="CSV file the summary is written to")
+    parser.add_argument("--households", type=int, default=150)
+    parser.add_argument("--companies", type=int, default=10)
+    parser.add_argument("--days", type=int, default=20000)
+    parser.add_argument("--replications", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="mesa")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="run_model parameter shared by all replicas")
+    args = parser.parse_args()
+
+    parameters = {}
+    for item in args.set:
+        name, value = item.split("=", 1)
+        parameters[name] = parse_value(value)
+    summary = run_ensemble(args.households, args.companies, args.days, args.replications, args.seed, args.engine,
+                           args.workers, **parameters)
+    summary.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
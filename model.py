@@ -1,191 +1,213 @@
 from mesa import Agent, Model
 from mesa.time import RandomActivation, BaseScheduler
-from mesa.datacollection import DataCollector
 import math
 import random
 from utils import *
-import networkx as nx
+from recorder import ArrayRecorder
+from profiling import PhaseProfiler, NULL_PHASE
+from convergence import make_monitor
+import numpy as np
+from scipy import sparse
+from network import load_network
 from tqdm import tqdm_notebook, tqdm
 
-marketing = {}
+# Parameters that can be changed on a running model (see LenExtended.set_parameters). Company
+# parameters map to the name of the Company attribute they are copied to.
+RUNTIME_HOUSEHOLD_PARAMETERS = ("wage_decreasing_coefficient", "critical_price_ratio", "consumption_power",
+                                "unemployed_attempts", "search_job_chance", "prob_search_price", "prob_search_prod",
+                                "use_marketing", "use_network")
+RUNTIME_COMPANY_PARAMETERS = {"demand_min": "demand_min_coefficient", "demand_max": "demand_max_coefficient",
+                              "sigma": "sigma", "gamma": "gamma", "phi_min": "phi_min", "phi_max": "phi_max",
+                              "tau": "tau", "upsilon": "upsilon", "lambda_coefficient": "lambda_coefficient",
+                              "money_buffer_coefficient": "money_buffer_coefficient",
+                              "marketing_investments": "marketing_investments", "use_marketing": "use_marketing"}
 
+# Agent methods timed when the model is created with profile=True
+PROFILED_HOUSEHOLD_METHODS = ("buy_goods", "end_of_month", "search_productive_firms", "search_cheaper_prices",
+                              "get_new_company_from_network", "search_new_job", "identify_consumption",
+                              "calculate_most_preferred", "update_penalties_preferred_social")
+PROFILED_COMPANY_METHODS = ("marketing_raise", "produce", "end_of_month", "change_marketing_investments",
+                            "invest_in_marketing", "pay_wages", "share_liquidity", "count_workers", "set_wage_rate",
+                            "hire_or_fire", "change_goods_price")
+
+
+# progress reporters that can be passed to run_model / simulate by name
+PROGRESS = {"notebook": tqdm_notebook, "tqdm": tqdm, "none": None}
+
+
+# price multiplier of every firm given its marketing boost, 0.6 once the boost exceeds 1600
+def marketing_factors(marketing_boost):
+    return np.maximum((100 - np.sqrt(marketing_boost))/100, 0.6)
+
+
+# Householders are plain objects with __slots__ rather than mesa Agents (whose instances carry a
+# __dict__), since there can be millions of them. Known firms are stored as firm ids, penalties and
+# preferences as small lists aligned with self.companies, and parameters are shared with the model.
+# The mesa schedulers only need unique_id and step().
+class Householder:
+    __slots__ = ("unique_id", "model", "pos", "params", "wealth", "wage", "consumption", "companies", "company",
+                 "penalty_companies", "preferred_companies", "most_preferred", "influenced_companies", "ranking",
+                 "social_factors")
 
-class Householder(Agent):
     def __init__(self, unique_id, model, household_parameters):
-        super().__init__(unique_id, model)
+        self.unique_id = unique_id
+        self.model = model
+        self.pos = None
+        self.params = household_parameters
         # initial sum of money of an agent
         self.wealth = random.randint(household_parameters.min_wealth, household_parameters.max_wealth)
         self.wage = household_parameters.default_wage  # reservation wage (expected wage)
         self.consumption = household_parameters.default_consumption  # how much goods does householder consume per day
-        self.companies = (random.sample(model.cmp_schedule.agents, 3))  # list of firms where householder can buy goods (type A connection)
+        self.companies = random.sample(range(model.num_cmp), 3)  # ids of firms where householder can buy goods (type A connection)
         # firm that householder works for
-        self.company = random.choice(self.model.cmp_schedule.agents)
-        self.company.households.append(self)
-        # if household was unemployed his reservation wage decreases by 10%
-        self.wage_decreasing_coefficient = household_parameters.wage_decreasing_coefficient
-        # if price in new company less that this value, replace company by new one
-        self.critical_price_ratio = household_parameters.critical_price_ratio
-        # in paper self.critical_price_ratio is reffed as xi = 0.01, but here it is (1-xi)
-        # allows not to spend all money for consumption (alpha)
-        self.consumption_power = household_parameters.consumption_power
-        # how many times unemployed household tries to find a job (beta)
-        self.unemployed_attempts = household_parameters.unemployed_attempts
-        # chance to search a job if wage is more than desired (pi)
-        self.search_job_chance = household_parameters.search_job_chance
-        # chance to search a better price (phi_price)
-        self.prob_search_price = household_parameters.prob_search_price
-        # chance to search a new firm with higher demand (phi_quant)
-        self.prob_search_prod = household_parameters.prob_search_prod
-        self.use_marketing = household_parameters.use_marketing
-        self.use_network = household_parameters.use_network
-        # number of type A connections (n)
-        self.a_connections_number = household_parameters.a_connections_number
-        self.penalty_companies = dict()
-        self.preferred_companies = dict()
-        self.social_influence = dict()
-        self.most_preferred = None
-        self.influenced_companies = dict()
-        for company in self.companies:
-            self.penalty_companies[company] = 0
-            self.preferred_companies[company] = 0
-            self.social_influence[company] = 1
+        self.company = random.choice(self.model.firms)
+        self.company.add_household(self)
+        # number of failed and successful purchases at every known firm during the month
+        self.penalty_companies = [0] * len(self.companies)
+        self.preferred_companies = [0] * len(self.companies)
+        self.most_preferred = None  # (firm id, number of purchases)
+        self.influenced_companies = dict()  # firm id -> social influence
+        # indices of self.companies sorted by effective price, valid until companies or influence change
+        self.ranking = None
+        self.social_factors = None
+
+    @property
+    def random(self):
+        return self.model.random
 
     def search_cheaper_prices(self):
-        if random.random() < self.prob_search_price:
+        if random.random() < self.params.prob_search_price:
             random_known_pick = random.choice(self.companies)
             company_to_add = self.add_firm_by_households()
-            if company_to_add.price / random_known_pick.price < self.critical_price_ratio:
+            firms = self.model.firms
+            if firms[company_to_add].price / firms[random_known_pick].price < self.params.critical_price_ratio:
                 self.companies.remove(random_known_pick)
                 self.companies.append(company_to_add)
+                self.invalidate_ranking()
 
     def add_firm_by_households(self):
-        firm_dict = dict()
-        for firm in self.model.cmp_schedule.agents:
-            if firm not in self.companies:
-                firm_dict[firm] = len(firm.households)
-        sorted_households = sorted(firm_dict.items(), key=lambda x: x[1])
-        company_to_add = None
-        if sorted_households:
-            company_to_add = draw_company(sorted_households)
-        return company_to_add
+        return self.model.labor_market.firm_sizes.draw(exclude=self.companies)
 
     def search_productive_firms(self):
-        if random.random() < self.prob_search_prod:
-            sorted_penalties = sorted(self.penalty_companies.items(), key=lambda x: x[1])
-            company_to_delete = draw_company(sorted_penalties)
+        if random.random() < self.params.prob_search_prod:
+            sorted_penalties = sorted(enumerate(self.penalty_companies), key=lambda x: x[1])
+            slot_to_delete = draw_company(sorted_penalties)
             company_to_add = self.add_firm_by_households()
+            del self.companies[slot_to_delete]
             self.companies.append(company_to_add)
-            self.companies.remove(company_to_delete)
+            self.invalidate_ranking()
 
     def get_new_company_from_network(self):
-        if random.random() < self.prob_search_prod:
+        if random.random() < self.params.prob_search_prod:
             if self.influenced_companies:
-                most_influenced = sorted(self.influenced_companies.items(), key=lambda x: x[1], reverse=True)[0][0]
+                most_influenced = max(self.influenced_companies.items(), key=lambda x: x[1])[0]
                 random_known_pick = random.choice(self.companies)
                 self.companies.remove(random_known_pick)
                 self.companies.append(most_influenced)
+                self.invalidate_ranking()
 
     def search_new_job(self):
-        for i in range(self.unemployed_attempts):
-            company = random.choice(self.model.cmp_schedule.agents)
-            if company.looking_for_worker:
+        for i in range(self.params.unemployed_attempts):
+            company = self.model.labor_market.probe()
+            if company is not None:
                 if self.company is not None:
                     if company.wage > self.company.wage:
                         if self.company.wage >= self.wage:
-                            if random.random() < self.search_job_chance:
-                                self.company.households.remove(self)
+                            if random.random() < self.params.search_job_chance:
+                                self.company.remove_household(self)
                                 self.company = company
-                                self.company.households.append(self)
+                                self.company.add_household(self)
                                 self.wage = self.company.wage
                                 self.company.looking_for_worker = False
                         else:
-                            self.company.households.remove(self)
+                            self.company.remove_household(self)
                             self.company = company
-                            self.company.households.append(self)
+                            self.company.add_household(self)
                             self.wage = self.company.wage
                             self.company.looking_for_worker = False
                     break
                 else:
                     if company.wage >= self.wage:
                         self.company = company
-                        self.company.households.append(self)
+                        self.company.add_household(self)
                         self.wage = self.company.wage
                         self.company.looking_for_worker = False
                         break
         else:
-            self.wage *= self.wage_decreasing_coefficient
+            self.wage *= self.params.wage_decreasing_coefficient
 
     def identify_consumption(self):
-        average_price = sum(company.price for company in self.companies) / len(self.companies)
-        self.consumption = int((self.wealth / (10 * average_price)) ** self.consumption_power)
-
-    def buy_goods(self):
-        def get_marketing_boost(marketing_boost):
-            if self.use_marketing:
-                if marketing_boost > 1600:
-                    return 0.6
-                if marketing_boost not in marketing:
-                    marketing[marketing_boost] = max((100 - math.sqrt(marketing_boost))/100, 0.6)
-                return marketing[marketing_boost]
+        firms = self.model.firms
+        average_price = sum(firms[company].price for company in self.companies) / len(self.companies)
+        self.consumption = int((self.wealth / (10 * average_price)) ** self.params.consumption_power)
+
+    def invalidate_ranking(self):
+        self.ranking = None
+        self.social_factors = None
+
+    def get_social_influence(self, infl_company):
+        if self.params.use_network:
+            infl = self.influenced_companies.get(infl_company)
+            if infl:
+                return max(1 - math.sqrt(infl)*0.01, 0.95)
             else:
                 return 1
-
-        def get_social_influence(infl_company):
-            if self.use_network:
-                infl = self.influenced_companies.get(infl_company)
-                if infl:
-                    return max(1 - math.sqrt(infl)*0.01, 0.95)
-                else:
-                    return 1
+        else:
+            return 1
+
+    # Companies sorted by price * marketing boost * social influence. The cached ranking is reused
+    # while it is still sorted under today's effective prices (ties keep the order of self.companies)
+    def get_ranking(self):
+        if self.social_factors is None:
+            self.social_factors = [self.get_social_influence(company) for company in self.companies]
+        effective_prices = self.model.effective_prices
+        keys = [effective_prices[company] * factor for company, factor in zip(self.companies, self.social_factors)]
+        ranking = self.ranking
+        if ranking is not None:
+            for i, j in zip(ranking, ranking[1:]):
+                if keys[i] > keys[j] or (keys[i] == keys[j] and i > j):
+                    break
             else:
-                return 1
+                self.model.ranking_hits += 1
+                return ranking
+        self.model.ranking_misses += 1
+        self.ranking = sorted(range(len(keys)), key=keys.__getitem__)
+        return self.ranking
 
-        for company in sorted(self.companies, key=lambda x: x.price * get_marketing_boost(x.marketing_boost) * get_social_influence(x)):
+    def buy_goods(self):
+        firms = self.model.firms
+        for i in self.get_ranking():
+            company = firms[self.companies[i]]
             total_price = int(self.consumption * company.price)
             company.demand += self.consumption
             if company.inventory < self.consumption:
-                self.penalty_companies[company] += 1
+                self.penalty_companies[i] += 1
             if (company.inventory > self.consumption) and (total_price < self.wealth):
                 self.wealth -= total_price
                 company.wealth += total_price
                 company.sold_last_month += self.consumption
                 company.inventory -= self.consumption
-                self.preferred_companies[company] += 1
+                self.preferred_companies[i] += 1
                 break
 
     def calculate_most_preferred(self):
-        self.most_preferred = sorted(self.preferred_companies.items(), key=lambda x: x[1], reverse=True)[0]
-
-    def calculate_social_influence(self):
-        neighbors_ids = list(self.model.social_network.neighbors(self.unique_id))
-        neighbor_companies = dict()
-        num_neigh = len(neighbors_ids)
-        for n_id in neighbors_ids:
-            neighbor_company_tuple = self.model.hh_schedule._agents[n_id].most_preferred
-            if neighbor_company_tuple is not None:
-                if neighbor_company_tuple[0] in neighbor_companies:
-                    neighbor_companies[neighbor_company_tuple[0]] += neighbor_company_tuple[1] / num_neigh
-                elif neighbor_company_tuple[1] != 0:
-                    neighbor_companies[neighbor_company_tuple[0]] = neighbor_company_tuple[1] / num_neigh
-        self.influenced_companies = neighbor_companies
+        slot = max(range(len(self.preferred_companies)), key=self.preferred_companies.__getitem__)
+        self.most_preferred = (self.companies[slot], self.preferred_companies[slot])
 
     def update_penalties_preferred_social(self):
-        self.penalty_companies = {}
-        self.preferred_companies = {}
-        self.social_influence = {}
-        for company in self.companies:
-            self.penalty_companies[company] = 0
-            self.preferred_companies[company] = 0
-            self.social_influence[company] = 1
+        for i in range(len(self.companies)):
+            self.penalty_companies[i] = 0
+            self.preferred_companies[i] = 0
 
+    # most_preferred is calculated first: penalties and preferences are aligned with self.companies,
+    # which the searches change
     def end_of_month(self):
+        self.calculate_most_preferred()
         self.search_productive_firms()
         self.search_cheaper_prices()
         self.get_new_company_from_network()
         self.search_new_job()
         self.identify_consumption()
-        self.calculate_most_preferred()
-        self.calculate_social_influence()
         self.update_penalties_preferred_social()
 
     def step(self):
@@ -204,6 +226,7 @@ class Company(Agent):
         # initial price of goods
         self.price = company_parameters.initial_price + random.randint(company_parameters.min_random_price,
                                                                        company_parameters.max_random_price)
+        self._looking_for_worker = False
         self.looking_for_worker = False  # True if firm is looking for an employee
         self.full_workplaces = 0  # number of days when we did not loose any employee
         self.workers_in_previous_month = 0  # number of worker on previous month to track if someone was hired
@@ -224,13 +247,30 @@ class Company(Agent):
         self.lambda_coefficient = company_parameters.lambda_coefficient
         # how much money does company saves for a month with bad sales
         self.money_buffer_coefficient = company_parameters.money_buffer_coefficient
-        self.households = []  # list of employees
+        self.households = IndexedSet()  # employees in the order they were hired
         self.marketing_investments = company_parameters.marketing_investments  # ratio of power invested in marketing
         self.marketing_boost = 0  # price multiplicator gathered from marketing investments
         self.start_marketing = company_parameters.start_marketing
         self.sold_last_month = 10
         self.use_marketing = company_parameters.use_marketing
 
+    @property
+    def looking_for_worker(self):
+        return self._looking_for_worker
+
+    @looking_for_worker.setter
+    def looking_for_worker(self, looking):
+        self._looking_for_worker = looking
+        self.model.labor_market.set_vacancy(self, looking)
+
+    def add_household(self, household):
+        self.households.add(household)
+        self.model.labor_market.firm_sizes.add(self.unique_id, 1)
+
+    def remove_household(self, household):
+        self.households.remove(household)
+        self.model.labor_market.firm_sizes.add(self.unique_id, -1)
+
     def produce(self):
         if self.use_marketing:
             self.inventory += len(self.households) * self.lambda_coefficient * (1 - self.marketing_investments)
@@ -288,9 +328,9 @@ class Company(Agent):
             self.looking_for_worker = False
         if self.inventory > self.demand_max_coefficient * self.sold_last_month:
             if self.households:
-                fired_h = self.households[0]
+                fired_h = self.households.first()
                 fired_h.company = None
-                del self.households[0]
+                self.remove_household(fired_h)
         self.demand = 0
         self.sold_last_month = 0
 
@@ -327,6 +367,13 @@ class Company(Agent):
         self.hire_or_fire()
         self.change_goods_price()
 
+    # Employees are pickled as ids and linked back by LenExtended.__setstate__, so that pickling
+    # does not recurse through the whole household <-> company graph
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["households"] = [h.unique_id for h in self.households.ordered()]
+        return state
+
     def step(self):
         self.marketing_raise()
         self.produce()
@@ -334,68 +381,182 @@ class Company(Agent):
             self.end_of_month()
 
 
+# Index of open vacancies and of firm sizes, kept up to date by Company on every hire, fire and
+# change of looking_for_worker
+class LaborMarket:
+    def __init__(self, number_of_firms):
+        self.number_of_firms = number_of_firms
+        self.vacancies = IndexedSet()  # firms looking for a worker
+        # size-weighted index of firms for add_firm_by_households
+        self.firm_sizes = FirmSizeIndex(number_of_firms)
+
+    def set_vacancy(self, company, looking):
+        if looking:
+            self.vacancies.add(company)
+        else:
+            self.vacancies.discard(company)
+
+    # Same outcome as checking looking_for_worker of a uniformly random firm: a random vacancy with
+    # probability vacancies / firms, otherwise None
+    def probe(self):
+        if not self.vacancies:
+            return None
+        if random.random() * self.number_of_firms < len(self.vacancies):
+            return self.vacancies.choice()
+        return None
+
+
+# Seed of the schedulers' generator, derived from the model seed so that its stream is independent of
+# the agents' one
+def scheduler_seed(seed):
+    if seed is None:
+        return None
+    return int(np.random.SeedSequence(seed).spawn(1)[0].generate_state(1)[0])
+
+
 class LenExtended(Model):
-    def __init__(self, num_hh, num_cmp, household_parameters, company_parameters, network_density):
+    def __init__(self, num_hh, num_cmp, household_parameters, company_parameters, network_density,
+                 datacollector=None, seed=None, profile=False, convergence=None, network=None):
+        # agents draw from the global random / np.random, the schedulers from self.random
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+        self.random = random.Random(scheduler_seed(seed))
 
         self.num_hh = num_hh
         self.num_cmp = num_cmp
+        self.household_parameters = household_parameters
+        self.company_parameters = company_parameters
         self.current_day = 0
+        self.running = True
         self.hh_schedule = RandomActivation(self)
         self.cmp_schedule = RandomActivation(self)
-        self.social_network = nx.barabasi_albert_graph(num_hh, network_density)
+        # CSR social network, see network.load_network
+        self.social_network = network if network is not None else load_network(num_hh, network_density, seed)
+        self.labor_market = LaborMarket(num_cmp)
+        self.firms = []  # companies by id
+        # price * marketing boost of every firm, recomputed once per day
+        self.use_marketing = household_parameters.use_marketing
+        self.effective_prices = []
+        self.ranking_hits = 0
+        self.ranking_misses = 0
         for i in range(self.num_cmp):
             c = Company(i, self, company_parameters)
             self.cmp_schedule.add(c)
+            self.firms.append(c)
 
         for i in range(self.num_hh):
             h = Householder(i, self, household_parameters)
             self.hh_schedule.add(h)
 
-        # Datacollector
-        self.datacollector = DataCollector(
-            # Household parameters
-            {"hh_wealth": lambda m: [x.wealth for x in self.hh_schedule.agent_buffer()],
-             "hh_wage": lambda m: [x.wage for x in self.hh_schedule.agent_buffer()],
-             "consumption": lambda m: h.consumption,
-             "companies": lambda m: h.companies,
-             "company": lambda m: [x.company for x in self.hh_schedule.agent_buffer()],
-             # "wage_decreasing_coefficient": lambda m: h.wage_decreasing_coefficient,
-             # "critical_price_ratio": lambda m: h.critical_price_ratio,
-             # "consumption_power": lambda m: h.consumption_power,
-             # "unemployed_attempts": lambda m: h.unemployed_attempts,
-             # "search_job_chance": lambda m: h.search_job_chance,
-             # "prob_search_price": lambda m: h.prob_search_price,
-             # "prob_search_prod": lambda m: h.prob_search_prod,
-             # "a_connections_number": lambda m: h.a_connections_number,
-
-             # Company parameters
-             "C_wealth": lambda m: c.wealth,
-             "C_wage": lambda m: c.wage,
-             "price": lambda m: [x.price for x in self.cmp_schedule.agent_buffer()],
-             "looking_for_worker": lambda m: c.looking_for_worker,
-             # "full_workplaces": lambda m: c.full_workplaces,
-             # "workers_in_previous_month": lambda m: c.workers_in_previous_month,
-             "demand": lambda m: c.demand,
-             # "demand_min_coefficient": lambda m: c.demand_min_coefficient,
-             # "demand_max_coefficient": lambda m: c.demand_max_coefficient,
-             "inventory": lambda m: [x.inventory for x in self.cmp_schedule.agent_buffer()],
-             # "sigma": lambda m: c.sigma,
-             "gamma": lambda m: c.gamma,
-             # "phi_min": lambda m: c.phi_min,
-             # "phi_max": lambda m: c.phi_max,
-             # "tau": lambda m: c.tau,
-             # "upsilon": lambda m: c.upsilon,
-             "lambda_coefficient": lambda m: c.lambda_coefficient,
-             # "money_buffer_coefficient": lambda m: c.money_buffer_coefficient,
-             "households": lambda m: [len(x.households) for x in self.cmp_schedule.agent_buffer()],
-             "marketing_investments": lambda m: [x.marketing_investments for x in self.cmp_schedule.agent_buffer()],
-             "marketing_boost": lambda m: c.marketing_boost})
+        self.datacollector = datacollector if datacollector is not None else ArrayRecorder()
+        # stops the run or thins out collection once it is stationary, see ConvergenceMonitor
+        self.convergence = make_monitor(convergence)
+
+        # wall time and calls per phase and agent method, see PhaseProfiler
+        self.profiler = PhaseProfiler() if profile else None
+        if profile:
+            for c in self.cmp_schedule.agent_buffer():
+                self.profiler.instrument(c, PROFILED_COMPANY_METHODS)
+            for h in self.hh_schedule.agent_buffer():
+                self.profiler.instrument(h, PROFILED_HOUSEHOLD_METHODS)
+
+    def phase(self, name):
+        if self.profiler is None:
+            return NULL_PHASE
+        return self.profiler.phase(name)
+
+    def record_state(self):
+        households = list(self.hh_schedule.agent_buffer())
+        companies = list(self.cmp_schedule.agent_buffer())
+        return {"hh_wealth": [h.wealth for h in households],
+                "hh_wage": [h.wage for h in households],
+                "consumption": [h.consumption for h in households],
+                "companies": [h.companies for h in households],
+                "company": [h.company.unique_id if h.company is not None else -1 for h in households],
+                "C_wealth": [c.wealth for c in companies],
+                "C_wage": [c.wage for c in companies],
+                "price": [c.price for c in companies],
+                "looking_for_worker": [c.looking_for_worker for c in companies],
+                "demand": [c.demand for c in companies],
+                "inventory": [c.inventory for c in companies],
+                "gamma": [c.gamma for c in companies],
+                "lambda_coefficient": [c.lambda_coefficient for c in companies],
+                "households": [len(c.households) for c in companies],
+                "marketing_investments": [c.marketing_investments for c in companies],
+                "marketing_boost": [c.marketing_boost for c in companies]}
+
+    def update_effective_prices(self):
+        prices = np.array([c.price for c in self.cmp_schedule.agent_buffer()], dtype=float)
+        if self.use_marketing:
+            boosts = np.array([c.marketing_boost for c in self.cmp_schedule.agent_buffer()], dtype=float)
+            prices *= marketing_factors(boosts)
+        self.effective_prices = prices.tolist()
+
+    # Sum of most_preferred scores of the neighbors of every household divided by its degree,
+    # written back into influenced_companies
+    def calculate_social_influence(self):
+        rows, cols, scores = [], [], []
+        for h in self.hh_schedule.agent_buffer():
+            if h.most_preferred is not None and h.most_preferred[1] != 0:
+                rows.append(h.unique_id)
+                cols.append(h.most_preferred[0])
+                scores.append(h.most_preferred[1])
+        preferred = sparse.csr_matrix((scores, (rows, cols)), shape=(self.num_hh, self.num_cmp))
+        # mean of the most preferred companies of the neighbors of every household at once
+        influence = self.social_network.neighbor_mean(preferred)
+        for h in self.hh_schedule.agent_buffer():
+            start, end = influence.indptr[h.unique_id], influence.indptr[h.unique_id + 1]
+            h.influenced_companies = dict(zip(influence.indices[start:end].tolist(),
+                                              influence.data[start:end].tolist()))
+            h.invalidate_ranking()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for c in self.cmp_schedule.agent_buffer():
+            c.households = IndexedSet(self.hh_schedule._agents[unique_id] for unique_id in c.households)
+
+    def set_parameters(self, **parameters):
+        for name, value in parameters.items():
+            if name not in RUNTIME_HOUSEHOLD_PARAMETERS and name not in RUNTIME_COMPANY_PARAMETERS:
+                raise ValueError(f'{name} cannot be changed after the model is created')
+            if name in RUNTIME_HOUSEHOLD_PARAMETERS:
+                setattr(self.household_parameters, name, value)
+            if name in RUNTIME_COMPANY_PARAMETERS:
+                setattr(self.company_parameters, name, value)
+                for c in self.cmp_schedule.agent_buffer():
+                    setattr(c, RUNTIME_COMPANY_PARAMETERS[name], value)
+            if name == "demand_min":
+                self.company_parameters.start_marketing = value * 1.5
+                for c in self.cmp_schedule.agent_buffer():
+                    c.start_marketing = value * 1.5
+            if name == "use_marketing":
+                self.use_marketing = value
+            if name == "use_network":
+                # the cached social factors of every household were computed with the old setting
+                for h in self.hh_schedule.agent_buffer():
+                    h.invalidate_ranking()
+
+    def ranking_cache_stats(self):
+        lookups = self.ranking_hits + self.ranking_misses
+        return {"hits": self.ranking_hits, "misses": self.ranking_misses,
+                "hit_rate": self.ranking_hits / lookups if lookups else 0.}
 
     def step(self):
-        self.cmp_schedule.step()
-        self.hh_schedule.step()
+        with self.phase("companies"):
+            self.cmp_schedule.step()
+        with self.phase("effective_prices"):
+            self.update_effective_prices()
+        with self.phase("households"):
+            self.hh_schedule.step()
         if self.current_day % 10 == 0:
-            self.datacollector.collect(self)
+            with self.phase("social_influence"):
+                self.calculate_social_influence()
+            with self.phase("collect"):
+                if self.convergence is None:
+                    self.datacollector.collect(self)
+                else:
+                    self.convergence.collect(self)
 
         self.current_day += 1
 
@@ -408,13 +569,22 @@ class HouseholdParameters:
         self.max_wealth = min_wealth * 2
         self.default_wage = default_wage
         self.default_consumption = default_consumption
+        # if household was unemployed his reservation wage decreases by 10%
         self.wage_decreasing_coefficient = wage_decreasing_coefficient
+        # if price in new company less that this value, replace company by new one
         self.critical_price_ratio = critical_price_ratio
+        # in paper self.critical_price_ratio is reffed as xi = 0.01, but here it is (1-xi)
+        # allows not to spend all money for consumption (alpha)
         self.consumption_power = consumption_power
+        # how many times unemployed household tries to find a job (beta)
         self.unemployed_attempts = unemployed_attempts
+        # chance to search a job if wage is more than desired (pi)
         self.search_job_chance = search_job_chance
+        # chance to search a better price (phi_price)
         self.prob_search_price = prob_search_price
+        # chance to search a new firm with higher demand (phi_quant)
         self.prob_search_prod = prob_search_price
+        # number of type A connections (n)
         self.a_connections_number = a_connections_number
         self.use_marketing = use_marketing
         self.use_network = use_network
@@ -457,7 +627,9 @@ def run_model(number_of_households, number_of_companies, number_of_steps, min_we
               min_random_price=0, max_random_price=20, demand=100, demand_min=0.25, demand_max=1, sigma=0.019,
               gamma=24, phi_min=1.025, phi_max=1.15, tau=0.75, upsilon=0.02, lambda_coefficient=3,
               money_buffer_coefficient=0.1, marketing_investments=0.2, use_marketing=True, use_network=True,
-              network_density=100):
+              network_density=100, model_cls=None, record_path=None, record_chunk=None, record_format='npy',
+              seed=None, progress=tqdm_notebook, profile=False, convergence=None, recorder=None, network_seed=None,
+              network_cache=None):
 
     household_parameters = HouseholdParameters(min_wealth, max_wealth, default_wage, default_consumption,
                                                wage_decreasing_coefficient, critical_price_ratio, consumption_power,
@@ -470,10 +642,36 @@ def run_model(number_of_households, number_of_companies, number_of_steps, min_we
                                            lambda_coefficient, money_buffer_coefficient, marketing_investments,
                                            use_marketing)
 
-    abm_model = LenExtended(number_of_households, number_of_companies, household_parameters, company_parameters,
-                            network_density)
-    for _ in tqdm_notebook(range(number_of_steps), total=number_of_steps, leave=False):
+    if model_cls is None:
+        model_cls = LenExtended
+    # collected every 10 days starting from day 0; with record_path data is flushed to disk in
+    # chunks of record_chunk months. A recorder passed in (e.g. a StreamRecorder) replaces it.
+    if recorder is None:
+        recorder = ArrayRecorder((number_of_steps + 9) // 10, record_path, record_chunk, record_format)
+    # the social network is drawn from network_seed (the model seed by default), so replications with
+    # different seeds can share one graph, which is cached in network_cache if given
+    network = load_network(number_of_households, network_density, seed if network_seed is None else network_seed,
+                           network_cache)
+    abm_model = model_cls(number_of_households, number_of_companies, household_parameters, company_parameters,
+                          network_density, recorder, seed=seed, profile=profile, convergence=convergence,
+                          network=network)
+    return simulate(abm_model, number_of_steps, progress)
+
+
+# Advance an existing model (e.g. one restored from a checkpoint) by number_of_steps days or until
+# the model stops running (see ConvergenceMonitor). progress is a tqdm-like callable wrapping the
+# range of days, None or one of the names in PROGRESS.
+def simulate(abm_model, number_of_steps, progress=tqdm_notebook):
+    if isinstance(progress, str):
+        progress = PROGRESS[progress]
+    steps = range(number_of_steps)
+    if progress is not None:
+        steps = progress(steps, total=number_of_steps, leave=False)
+    for _ in steps:
+        if not abm_model.running:
+            break
         abm_model.step()
+    abm_model.datacollector.flush()
 
     return abm_model
 
@@ -0,0 +1,115 @@
+import os
+import numpy as np
+from scipy import sparse
+
+
+# Undirected social network as CSR adjacency: the neighbors of node i are
+# indices[indptr[i]:indptr[i + 1]]. Networks loaded from the cache are memory-mapped, so runs with the
+# same graph share its pages, and are pickled (e.g. in checkpoints) as the path of the cached files.
+class SocialNetwork:
+    def __init__(self, indptr, indices, path=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.path = path  # prefix of the cached .npy files
+        self.degree = np.diff(indptr)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def number_of_edges(self):
+        return len(self.indices) // 2
+
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    # Mean over the neighbors of every node of the rows of a sparse (nodes x k) matrix, as a CSR matrix
+    def neighbor_mean(self, matrix):
+        adjacency = sparse.csr_matrix((np.ones(len(self.indices), dtype=np.float32), self.indices, self.indptr),
+                                      shape=(len(self), len(self)))
+        result = (adjacency @ matrix).tocsr()
+        result.data /= np.repeat(np.maximum(self.degree, 1), np.diff(result.indptr))
+        return result
+
+    def save(self, path):
+        # indices are written last, their file marks a complete entry
+        for name in ("indptr", "indices"):
+            temporary = f"{path}_{name}.{os.getpid()}.tmp.npy"
+            np.save(temporary, getattr(self, name))
+            os.replace(temporary, f"{path}_{name}.npy")
+
+    def __getstate__(self):
+        if self.path is None:
+            return self.__dict__
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        if "indices" in state:
+            self.__dict__.update(state)
+        else:
+            loaded = load_files(state["path"])
+            self.__dict__.update(loaded.__dict__)
+
+
+def load_files(path):
+    return SocialNetwork(np.load(f"{path}_indptr.npy", mmap_mode="r"), np.load(f"{path}_indices.npy", mmap_mode="r"),
+                         path)
+
+
+# Independent seed sequences of a model's own draws and of its network, spawned from one seed, so that
+# the two streams are not the same sequence when the network seed is the model seed
+def spawn_seeds(seed):
+    model_seed, network_seed = np.random.SeedSequence(seed).spawn(2)
+    return model_seed, network_seed
+
+
+# Preferential attachment graph with the algorithm of networkx.barabasi_albert_graph: a star of m + 1
+# nodes, then every new node is linked to m distinct nodes drawn with probability proportional to
+# their degree. Generated with numpy straight into CSR arrays (int32 where they fit).
+def barabasi_albert(number_of_nodes, m, seed=None):
+    if m < 1 or m >= number_of_nodes:
+        raise ValueError(f"Barabasi-Albert network must have m >= 1 and m < n, m = {m}, n = {number_of_nodes}")
+    generator = np.random.default_rng(spawn_seeds(seed)[1])
+    number_of_edges = m + (number_of_nodes - m - 1) * m
+    sources = np.empty(number_of_edges, dtype=np.int32)
+    targets = np.empty(number_of_edges, dtype=np.int32)
+    # every node once per end of its edges, so that uniform draws from it are degree-weighted
+    repeated = np.empty(2 * number_of_edges, dtype=np.int32)
+    sources[:m] = 0
+    targets[:m] = np.arange(1, m + 1)
+    repeated[:m] = 0
+    repeated[m:2 * m] = targets[:m]
+    length = 2 * m
+    for source in range(m + 1, number_of_nodes):
+        chosen = np.unique(repeated[generator.integers(0, length, m)])
+        while len(chosen) < m:
+            extra = repeated[generator.integers(0, length, m - len(chosen))]
+            chosen = np.unique(np.concatenate([chosen, extra]))
+        edge = m * (source - m)
+        sources[edge:edge + m] = source
+        targets[edge:edge + m] = chosen
+        repeated[length:length + m] = chosen
+        repeated[length + m:length + 2 * m] = source
+        length += 2 * m
+    del repeated
+
+    rows = np.concatenate([sources, targets])
+    cols = np.concatenate([targets, sources])
+    del sources, targets
+    order = np.argsort(rows, kind="stable")
+    index_type = np.int32 if len(rows) < 2 ** 31 else np.int64
+    indices = cols[order]
+    indptr = np.zeros(number_of_nodes + 1, dtype=index_type)
+    np.cumsum(np.bincount(rows, minlength=number_of_nodes), out=indptr[1:])
+    return SocialNetwork(indptr, indices)
+
+
+# Network of a model. With a cache directory and a seed the graph is generated once, stored as .npy
+# files named by (number_of_nodes, m, seed) and memory-mapped by every later run.
+def load_network(number_of_nodes, m, seed=None, cache=None):
+    if cache is None or seed is None:
+        return barabasi_albert(number_of_nodes, m, seed)
+    path = os.path.join(cache, f"barabasi_albert_{number_of_nodes}_{m}_{seed}")
+    if not os.path.exists(f"{path}_indices.npy"):
+        os.makedirs(cache, exist_ok=True)
+        barabasi_albert(number_of_nodes, m, seed).save(path)
+    return load_files(path)
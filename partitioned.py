@@ -0,0 +1,366 @@
+import ctypes
+import functools
+import inspect
+import multiprocessing
+import numpy as np
+from model import run_model as run_mesa_model, RUNTIME_HOUSEHOLD_PARAMETERS
+from recorder import ArrayRecorder
+from profiling import PhaseProfiler
+from convergence import make_monitor
+from network import load_network, load_files, spawn_seeds
+from vectorized import LenVectorized, KNOWN_FIRMS
+
+# household arrays of record_state, kept by the shards
+HOUSEHOLD_STATE = ("hh_wealth", "hh_wage", "consumption", "companies", "company")
+
+
+# Households from start to stop of a LenPartitioned model, run in a worker process. It is the
+# household half of LenVectorized: firm state arrives with the messages of the coordinator and
+# firm-side results are sent back. most_preferred and most_preferred_count are views into arrays
+# shared by all shards, so that social influence can read the neighbors in other shards once every
+# shard has written its values.
+class HouseholdShard(LenVectorized):
+
+    def __init__(self, start, stop, num_cmp, household_parameters, seed, network, shared_preferred, shared_count):
+        self.rng = np.random.default_rng(seed)
+        self.month_draws = None
+        self.start = start
+        self.num_hh = stop - start
+        self.num_cmp = num_cmp
+        self.household_parameters = household_parameters
+        self.init_households()
+        self.hired_at += start  # global hiring order
+        self.all_preferred = np.frombuffer(shared_preferred, dtype=np.int64)
+        self.all_count = np.frombuffer(shared_count, dtype=np.float64)
+        self.most_preferred = self.all_preferred[start:stop]
+        self.most_preferred_count = self.all_count[start:stop]
+        self.most_preferred[:] = -1
+        # rows of the shard in the social network, neighbors keep their global ids
+        if isinstance(network, str):
+            network = load_files(network)
+        first, last = network.indptr[start], network.indptr[stop]
+        self.social_network = type(network)(network.indptr[start:stop + 1] - first, network.indices[first:last])
+        self.active = np.zeros(self.num_hh, dtype=bool)
+        self.profiler = None
+        # firm state, sent by the coordinator
+        self.price = self.cmp_wage = self.looking_for_worker = self.firm_employees = None
+
+    def employees(self):
+        return self.firm_employees
+
+    def set_parameters(self, **parameters):
+        for name, value in parameters.items():
+            setattr(self.household_parameters, name, value)
+
+    def employees_per_firm(self):
+        return LenVectorized.employees(self)
+
+    def preferred_of(self, households):
+        return self.all_preferred[households], self.all_count[households]
+
+    # pay_wages and share_liquidity of the employees; returns the employee hired first by every firm,
+    # as (firms, hired_at, rows), for hire_or_fire
+    def pay(self, wage, liquidity):
+        employed = self.company >= 0
+        employers = self.company[employed]
+        self.hh_wealth[employed] += wage[employers]
+        self.hh_wage[employed] = np.maximum(self.hh_wage[employed], wage[employers])
+        self.hh_wealth[employed] += liquidity[employers]
+        self.hh_wage[employed] += liquidity[employers]
+        rows = np.flatnonzero(employed)
+        rows = rows[np.lexsort((self.hired_at[rows], self.company[rows]))]
+        first = np.concatenate([[True], self.company[rows][1:] != self.company[rows][:-1]]) if len(rows) else []
+        rows = rows[first]
+        return self.company[rows], self.hired_at[rows], rows
+
+    # Start of households_end_of_month up to the applications of the first search_new_job attempt
+    def month(self, fired, price, cmp_wage, looking_for_worker, employees):
+        self.company[fired] = -1
+        self.price, self.cmp_wage = price, cmp_wage
+        self.looking_for_worker, self.firm_employees = looking_for_worker, employees
+        self.draw_month()
+        self.calculate_most_preferred()
+        self.search_productive_firms()
+        self.search_cheaper_prices()
+        self.get_new_company_from_network()
+        self.active[:] = True
+        return self.applications()
+
+    # (rows, firms, rank) of the applicants; the coordinator gives each vacancy to the lowest rank
+    def applications(self):
+        rows, firms = self.job_applications(self.active)
+        return rows, firms, self.month_draws[0, rows]
+
+    def hire(self, rows, firms, hired_at, looking_for_worker, more):
+        self.company[rows] = firms
+        self.hired_at[rows] = hired_at
+        self.hh_wage[rows] = self.cmp_wage[firms]
+        self.active[rows] = False
+        self.looking_for_worker = looking_for_worker
+        return self.applications() if more else None
+
+    # End of households_end_of_month, sent once every shard has written its most_preferred
+    def finish(self):
+        self.hh_wage[self.active] *= self.household_parameters.wage_decreasing_coefficient
+        self.identify_consumption()
+        self.calculate_social_influence()
+        self.penalty_companies[:] = 0
+        self.preferred_companies[:] = 0
+        return self.employees_per_firm()
+
+    # buy_goods of LenVectorized against this shard's share of the inventory of every firm; returns
+    # the demand, units sold and revenue of every firm
+    def buy(self, inventory, price, marketing_boost, day_of_month):
+        self.price, self.marketing_boost, self.inventory = price, marketing_boost, inventory
+        self.demand, self.sold_last_month, self.cmp_wealth = (np.zeros(self.num_cmp) for _ in range(3))
+        self.buy_goods(self.month_draws[day_of_month])
+        return self.demand, self.sold_last_month, self.cmp_wealth
+
+    def state(self):
+        return tuple(getattr(self, name) for name in HOUSEHOLD_STATE)
+
+
+# Worker process: executes the coordinator's commands on its shard until "close" or until the
+# coordinator goes away
+def serve_shard(connection, arguments):
+    shard = HouseholdShard(*arguments)
+    connection.send(shard.employees_per_firm())
+    while True:
+        try:
+            command, args, kwargs = connection.recv()
+        except EOFError:
+            break
+        if command == "close":
+            break
+        connection.send(getattr(shard, command)(*args, **kwargs))
+    connection.close()
+
+
+# LenVectorized with the households split into shards run by worker processes, while firms stay in
+# this process, which coordinates the shards. They exchange batched messages at fixed points:
+# - at the end of the month wages and liquidity go to the shards, which reply with the first-hired
+#   employee of every firm (for firing); in every search_new_job attempt the shards send their
+#   applications and each vacancy goes to the applicant with the lowest random rank in any shard;
+# - every day each shard buys against a share of the inventory of each firm, proportional to its
+#   recent demand there, and replies with the demand, sales and revenue per firm.
+# most_preferred values are exchanged once a month through shared memory. Contention for goods is
+# resolved within a shard, so runs are statistically equivalent to LenVectorized, not identical,
+# and depend on the number of shards.
+class LenPartitioned(LenVectorized):
+
+    def __init__(self, num_hh, num_cmp, household_parameters, company_parameters, network_density,
+                 datacollector=None, seed=None, profile=False, convergence=None, network=None, shards=None):
+        # the shards draw from independent streams spawned from the model's
+        seeds = spawn_seeds(seed)[0]
+        self.rng = np.random.default_rng(seeds)
+        if num_cmp < KNOWN_FIRMS:
+            raise ValueError(f"every householder knows {KNOWN_FIRMS} firms, got {num_cmp} firms")
+        self.num_hh = num_hh
+        self.num_cmp = num_cmp
+        self.current_day = 0
+        self.running = True
+        self.household_parameters = household_parameters
+        self.company_parameters = company_parameters
+        self.init_companies()
+        self.hires = num_hh
+        self.fired = None  # rows fired in every shard this month
+
+        if network is None:
+            network = load_network(num_hh, network_density, seed)
+        self.social_network = network
+        shards = shards or multiprocessing.cpu_count()
+        self.bounds = np.linspace(0, num_hh, shards + 1).astype(np.int64)
+        seeds = seeds.spawn(shards)
+        context = multiprocessing.get_context()
+        shared_preferred = context.RawArray(ctypes.c_int64, num_hh)
+        shared_count = context.RawArray(ctypes.c_double, num_hh)
+        # shards memory-map a cached network instead of receiving a copy
+        shard_network = network.path if network.path is not None else network
+        self.connections, self.processes = [], []
+        for i in range(shards):
+            arguments = (self.bounds[i], self.bounds[i + 1], num_cmp, household_parameters, seeds[i], shard_network,
+                         shared_preferred, shared_count)
+            connection, child = context.Pipe()
+            process = context.Process(target=serve_shard, args=(child, arguments), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.firm_employees = sum(connection.recv() for connection in self.connections)
+        # recent demand of every shard at every firm, for the daily inventory shares
+        self.shard_demand = np.repeat(np.diff(self.bounds)[:, None].astype(float), num_cmp, axis=1)
+
+        self.datacollector = datacollector if datacollector is not None else ArrayRecorder()
+        self.convergence = make_monitor(convergence)
+        self.profiler = PhaseProfiler() if profile else None
+
+    # Sends a command to every shard, with per_shard[i] prepended to the arguments of shard i, and
+    # returns their replies
+    def broadcast(self, command, *args, per_shard=None, **kwargs):
+        for i, connection in enumerate(self.connections):
+            connection.send((command, args if per_shard is None else per_shard[i] + args, kwargs))
+        return [connection.recv() for connection in self.connections]
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            if process.is_alive():
+                connection.send(("close", (), {}))
+            process.join()
+        self.connections, self.processes = [], []
+
+    # shards of a model that is no longer referenced, e.g. by a sweep worker, are stopped with it
+    def __del__(self):
+        if getattr(self, "processes", None):
+            self.close()
+
+    def __getstate__(self):
+        raise TypeError("LenPartitioned cannot be pickled, its households live in worker processes")
+
+    def employees(self):
+        return self.firm_employees
+
+    def record_state(self):
+        cp = self.company_parameters
+        state = {name: np.concatenate(parts) for name, parts in zip(HOUSEHOLD_STATE, zip(*self.broadcast("state")))}
+        state.update({"C_wealth": self.cmp_wealth,
+                      "C_wage": self.cmp_wage,
+                      "price": self.price,
+                      "looking_for_worker": self.looking_for_worker,
+                      "demand": self.demand,
+                      "inventory": self.inventory,
+                      "gamma": np.full(self.num_cmp, cp.gamma, dtype=float),
+                      "lambda_coefficient": np.full(self.num_cmp, cp.lambda_coefficient, dtype=float),
+                      "households": self.employees(),
+                      "marketing_investments": self.marketing_investments,
+                      "marketing_boost": self.marketing_boost})
+        return state
+
+    def set_parameters(self, **parameters):
+        super().set_parameters(**parameters)
+        self.broadcast("set_parameters", **{name: value for name, value in parameters.items()
+                                            if name in RUNTIME_HOUSEHOLD_PARAMETERS})
+
+    # LenVectorized.companies_end_of_month with the employees in the shards
+    def companies_end_of_month(self):
+        cp = self.company_parameters
+        num_cmp = self.num_cmp
+
+        # change_marketing_investments
+        threshold = cp.start_marketing * self.sold_last_month
+        more = (self.inventory > threshold) & (self.marketing_investments < 0.5)
+        less = ~more & (self.inventory < threshold * 0.5) & (self.marketing_investments > 0.01)
+        self.marketing_investments[more] += 0.03
+        self.marketing_investments[less] -= 0.01
+
+        # invest_in_marketing
+        self.marketing_boost *= 0.8
+
+        # pay_wages and share_liquidity
+        households = self.employees()
+        staffed = households > 0
+        broke = staffed & (households * self.cmp_wage > self.cmp_wealth)
+        self.cmp_wage[broke] = np.trunc(self.cmp_wealth[broke] / households[broke])
+        self.cmp_wealth -= households * self.cmp_wage
+        wage = self.cmp_wage.copy()
+        buffer = self.cmp_wage * households * cp.money_buffer_coefficient
+        liquidity = np.zeros(num_cmp)
+        liquidity[staffed] = np.trunc((self.cmp_wealth[staffed] - buffer[staffed]) / households[staffed])
+        liquidity[liquidity < 0] = 0
+        self.cmp_wage += liquidity
+        self.cmp_wealth -= liquidity * households
+        first_hired = self.broadcast("pay", wage, liquidity)
+
+        # count_workers
+        kept = households >= self.workers_in_previous_month
+        self.full_workplaces = np.where(kept, self.full_workplaces + 1, 0)
+        self.workers_in_previous_month = households
+
+        # set_wage_rate
+        raise_wage = self.looking_for_worker
+        self.cmp_wage[raise_wage] *= 1 + self.rng.uniform(0, cp.sigma, raise_wage.sum())
+        cut_wage = self.full_workplaces > cp.gamma
+        self.cmp_wage[cut_wage] *= 1 - self.rng.uniform(0, cp.sigma, cut_wage.sum())
+
+        # hire_or_fire: the employee hired first, whichever shard it is in
+        self.looking_for_worker = self.inventory <= cp.demand_min * self.sold_last_month
+        fire = (self.inventory > cp.demand_max * self.sold_last_month) & staffed
+        earliest = np.full(num_cmp, np.iinfo(np.int64).max)
+        owner = np.zeros(num_cmp, dtype=np.int64)
+        row = np.zeros(num_cmp, dtype=np.int64)
+        for i, (firms, hired_at, rows) in enumerate(first_hired):
+            earlier = hired_at < earliest[firms]
+            firms, hired_at, rows = firms[earlier], hired_at[earlier], rows[earlier]
+            earliest[firms], owner[firms], row[firms] = hired_at, i, rows
+        self.fired = [row[fire & (owner == i)] for i in range(len(self.connections))]
+        self.firm_employees = households - fire
+        self.demand[:] = 0
+        self.sold_last_month[:] = 0
+
+        # change_goods_price
+        marginal_costs = self.cmp_wage / (10 * cp.lambda_coefficient)
+        increase = (self.price < cp.phi_min * marginal_costs) & (self.rng.random(num_cmp) < cp.tau)
+        self.price[increase] *= 1 + self.rng.uniform(0, cp.upsilon, increase.sum())
+        decrease = (self.price > cp.phi_max * marginal_costs) & (self.rng.random(num_cmp) < cp.tau)
+        self.price[decrease] *= 1 - self.rng.uniform(0, cp.upsilon, decrease.sum())
+
+    def households_end_of_month(self):
+        hp = self.household_parameters
+        applications = self.broadcast("month", self.price, self.cmp_wage, self.looking_for_worker,
+                                      self.firm_employees, per_shard=[(rows,) for rows in self.fired])
+        for attempt in range(hp.unemployed_attempts):
+            shards = np.concatenate([np.full(len(rows), i) for i, (rows, _, _) in enumerate(applications)])
+            rows, firms, rank = (np.concatenate(parts) for parts in zip(*applications))
+            order = np.lexsort((rank, firms))
+            shards, rows, firms = shards[order], rows[order], firms[order]
+            winners = np.concatenate([[True], firms[1:] != firms[:-1]]) if len(rows) else np.zeros(0, bool)
+            shards, rows, firms = shards[winners], rows[winners], firms[winners]
+            hired_at = self.hires + np.arange(len(rows))
+            self.hires += len(rows)
+            self.looking_for_worker[firms] = False
+            per_shard = [(rows[shards == i], firms[shards == i], hired_at[shards == i])
+                         for i in range(len(self.connections))]
+            applications = self.broadcast("hire", self.looking_for_worker, attempt + 1 < hp.unemployed_attempts,
+                                          per_shard=per_shard)
+        self.firm_employees = sum(self.broadcast("finish"))
+
+    def buy_goods(self, day_of_month):
+        total = self.shard_demand.sum(axis=0)
+        shares = np.where(total > 0, self.shard_demand / np.where(total > 0, total, 1), 1 / len(self.connections))
+        replies = self.broadcast("buy", self.price, self.marketing_boost, day_of_month,
+                                 per_shard=[(self.inventory * share,) for share in shares])
+        demand, sold, revenue = (np.array(parts) for parts in zip(*replies))
+        # inventory shares follow the demand of the last days
+        self.shard_demand = 0.5 * self.shard_demand + demand
+        self.demand += demand.sum(axis=0)
+        self.cmp_wealth += revenue.sum(axis=0)
+        self.sold_last_month += sold.sum(axis=0)
+        self.inventory -= sold.sum(axis=0)
+
+    def step(self):
+        month = self.current_day % 10 == 0
+        with self.phase("companies"):
+            self.companies_step()
+        if month:
+            with self.phase("households_end_of_month"):
+                self.households_end_of_month()
+        with self.phase("buy_goods"):
+            self.buy_goods(self.current_day % 10)
+        if month:
+            with self.phase("collect"):
+                if self.convergence is None:
+                    self.datacollector.collect(self)
+                else:
+                    self.convergence.collect(self)
+
+        self.current_day += 1
+
+
+# model.run_model with the number of household shards, one worker process each. The default is
+# resolved to the number of CPUs here, so that callers reading the signature (cli, cache) see it.
+def run_model(*args, shards=multiprocessing.cpu_count(), **kwargs):
+    return run_mesa_model(*args, model_cls=functools.partial(LenPartitioned, shards=shards), **kwargs)
+
+
+run_model.__signature__ = inspect.signature(run_mesa_model).replace(parameters=[
+    *inspect.signature(run_mesa_model).parameters.values(),
+    inspect.Parameter("shards", inspect.Parameter.KEYWORD_ONLY, default=multiprocessing.cpu_count())])
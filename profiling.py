@@ -0,0 +1,100 @@
+from contextlib import nullcontext
+from time import perf_counter
+import pandas as pd
+
+# returned by phase() when profiling is disabled
+NULL_PHASE = nullcontext()
+
+
+def new_agent(cls):
+    return cls.__new__(cls)
+
+
+# Pickle state of an agent: the plain class's own __getstate__ if it defines one (Company pickles
+# its employees as ids), otherwise its __dict__, or (__dict__, slots) if it has slots, which
+# unpickling restores on any class without __setstate__ (object.__getstate__ is only available from
+# Python 3.11)
+def agent_state(cls, agent):
+    if any("__getstate__" in vars(klass) for klass in cls.__mro__[:-1]):
+        return cls.__getstate__(agent)
+    slots = {}
+    for klass in cls.__mro__:
+        names = getattr(klass, "__slots__", ())
+        for name in (names,) if isinstance(names, str) else names:
+            if name not in ("__dict__", "__weakref__") and hasattr(agent, name):
+                slots[name] = getattr(agent, name)
+    state = getattr(agent, "__dict__", None)
+    return (state, slots) if slots else state
+
+
+class Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, perf_counter() - self.start)
+        return False
+
+
+# Accumulates wall time and number of calls per model phase and per agent method. Agent methods are
+# timed by switching the agents to a subclass whose methods are wrapped (see instrument), so agents
+# of models created without a profiler run the plain methods with no overhead.
+class PhaseProfiler:
+    def __init__(self):
+        self.records = {}  # name -> [calls, seconds]
+        self.phases = {}
+        self.subclasses = {}
+
+    def add(self, name, seconds):
+        record = self.records.get(name)
+        if record is None:
+            self.records[name] = [1, seconds]
+        else:
+            record[0] += 1
+            record[1] += seconds
+
+    def phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(self, "phase." + name)
+        return phase
+
+    def timed(self, name, function):
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, perf_counter() - start)
+        wrapper.__name__ = function.__name__
+        return wrapper
+
+    def instrument(self, agent, method_names):
+        cls = type(agent)
+        subclass = self.subclasses.get(cls)
+        if subclass is None:
+            methods = {name: self.timed(f"{cls.__name__}.{name}", getattr(cls, name)) for name in method_names}
+            methods["__slots__"] = ()
+            # pickled (e.g. in a checkpoint) as the plain agent class
+            methods["__reduce_ex__"] = lambda agent, protocol: (new_agent, (cls,), agent_state(cls, agent))
+            subclass = self.subclasses[cls] = type(cls.__name__, (cls,), methods)
+        agent.__class__ = subclass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["subclasses"] = {}
+        return state
+
+    def as_dict(self):
+        return {name: {"calls": calls, "seconds": seconds, "mean_seconds": seconds / calls}
+                for name, (calls, seconds) in self.records.items()}
+
+    def to_dataframe(self):
+        table = pd.DataFrame.from_dict(self.as_dict(), orient="index")
+        return table.sort_values("seconds", ascending=False) if len(table) else table
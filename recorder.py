@@ -0,0 +1,212 @@
+import csv
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# dtype of every variable collected by the models, household variables first
+FIELDS = {"hh_wealth": np.float64,
+          "hh_wage": np.float64,
+          "consumption": np.float64,
+          "companies": np.int32,  # ids of known firms of every household
+          "company": np.int32,  # id of the employer, -1 if unemployed
+          "C_wealth": np.float64,
+          "C_wage": np.float64,
+          "price": np.float64,
+          "looking_for_worker": np.bool_,
+          "demand": np.float64,
+          "inventory": np.float64,
+          "gamma": np.float64,
+          "lambda_coefficient": np.float64,
+          "households": np.int32,
+          "marketing_investments": np.float64,
+          "marketing_boost": np.float64}
+
+
+# Replacement for mesa DataCollector. Every collect() copies model.record_state() into preallocated
+# NumPy arrays with one row per collected month. If path is given the buffer holds chunk_size months
+# and is written to disk as .npy files (or Parquet) whenever it fills up, so memory does not grow
+# with the length of the run.
+class ArrayRecorder:
+    def __init__(self, number_of_records=None, path=None, chunk_size=None, file_format='npy'):
+        if file_format not in ('npy', 'parquet'):
+            raise ValueError(f'Unknown file format: {file_format}')
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.file_format = file_format
+        self.capacity = chunk_size or number_of_records or 64
+        if path is not None and chunk_size is None:
+            self.capacity = min(self.capacity, 100)
+        self.arrays = None
+        self.shapes = None
+        self.length = 0  # rows in the buffer
+        self.chunks = []  # number of rows in every flushed chunk
+
+    def allocate(self, state):
+        self.shapes = {name: np.shape(value) for name, value in state.items()}
+        self.arrays = {name: np.empty((self.capacity,) + shape, dtype=FIELDS[name])
+                       for name, shape in self.shapes.items()}
+
+    # Use arrays collected earlier (e.g. loaded from the run cache), one row per month
+    def set_arrays(self, arrays):
+        self.arrays = dict(arrays)
+        self.shapes = {name: array.shape[1:] for name, array in self.arrays.items()}
+        self.capacity = self.length = len(next(iter(self.arrays.values()), ()))
+
+    def collect(self, model):
+        state = model.record_state()
+        if self.arrays is None:
+            self.allocate(state)
+        if self.length == self.capacity:
+            if self.path is not None:
+                self.flush()
+            else:
+                self.capacity *= 2
+                for name, array in self.arrays.items():
+                    self.arrays[name] = np.concatenate([array, np.empty_like(array)])
+        for name, value in state.items():
+            self.arrays[name][self.length] = value
+        self.length += 1
+        return state
+
+    def chunk_file(self, chunk, name=None):
+        if self.file_format == 'parquet':
+            return os.path.join(self.path, f'chunk_{chunk:05d}.parquet')
+        return os.path.join(self.path, f'{name}_{chunk:05d}.npy')
+
+    def flush(self):
+        if self.path is None or self.length == 0:
+            return
+        chunk = len(self.chunks)
+        if self.file_format == 'parquet':
+            table = pd.DataFrame({name: list(array[:self.length].reshape(self.length, -1))
+                                  for name, array in self.arrays.items()})
+            table.to_parquet(self.chunk_file(chunk))
+        else:
+            for name, array in self.arrays.items():
+                np.save(self.chunk_file(chunk, name), array[:self.length])
+        self.chunks.append(self.length)
+        self.length = 0
+
+    # Copy the chunks written so far to another directory and continue writing there, used when
+    # several runs are branched from one checkpoint
+    def move_to(self, path):
+        os.makedirs(path, exist_ok=True)
+        for chunk in range(len(self.chunks)):
+            names = [None] if self.file_format == 'parquet' else list(self.shapes)
+            for name in names:
+                shutil.copy(self.chunk_file(chunk, name), path)
+        self.path = path
+
+    def load_chunk(self, chunk, name):
+        if self.file_format == 'parquet':
+            column = pd.read_parquet(self.chunk_file(chunk), columns=[name])[name]
+            return np.stack(column.to_numpy()).astype(FIELDS[name]).reshape((-1,) + self.shapes[name])
+        return np.load(self.chunk_file(chunk, name), mmap_mode='r')
+
+    def __len__(self):
+        return sum(self.chunks) + self.length
+
+    def get_array(self, name):
+        parts = [self.load_chunk(chunk, name) for chunk in range(len(self.chunks))]
+        if self.arrays is not None:
+            parts.append(self.arrays[name][:self.length])
+        if not parts:
+            return np.empty(0, dtype=FIELDS[name])
+        return np.concatenate(parts)
+
+    def get_model_vars_dataframe(self):
+        if self.arrays is None:
+            return pd.DataFrame()
+        data = {}
+        for name in self.shapes:
+            values = self.get_array(name)
+            data[name] = values.tolist() if values.ndim > 1 else values
+        return pd.DataFrame(data)
+
+
+AGGREGATES = ("price", "hh_wage", "hh_wealth", "total_hh_wealth", "employment", "unemployment", "monopoly",
+              "inventory", "marketing_boost")
+
+
+# Aggregate statistics of one collected month (the keys of AGGREGATES), as used by sweeps and summaries
+def aggregate_state(state):
+    households = np.asarray(state["households"])
+    number_of_households = len(state["hh_wealth"])
+    median = max(np.median(households), 1)
+    return {"price": float(np.mean(state["price"])),
+            "hh_wage": float(np.mean(state["hh_wage"])),
+            "hh_wealth": float(np.mean(state["hh_wealth"])),
+            "total_hh_wealth": float(np.sum(state["hh_wealth"])),
+            "employment": float(households.sum() / number_of_households),
+            "unemployment": float(1 - households.sum() / number_of_households),
+            "monopoly": float(households.max() / median),
+            "inventory": float(np.sum(state["inventory"])),
+            "marketing_boost": float(np.mean(state["marketing_boost"]))}
+
+
+# Writes the aggregates of every collected month (day plus AGGREGATES) to a JSONL, CSV or Parquet
+# file while the model runs, instead of keeping the full state in memory. JSONL and CSV rows are
+# flushed as they are written so the file can be followed during a run; Parquet rows are written in
+# row groups of row_group_size months and the file is only readable after close().
+class StreamRecorder:
+    def __init__(self, path, file_format=None, row_group_size=100):
+        if file_format is None:
+            file_format = os.path.splitext(path)[1].lstrip('.')
+            file_format = 'jsonl' if file_format == 'json' else file_format
+        if file_format not in ('jsonl', 'csv', 'parquet'):
+            raise ValueError(f'Unknown file format: {file_format}')
+        self.path = path
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.columns = ("day",) + AGGREGATES
+        self.rows = []  # rows of the next Parquet row group
+        self.length = 0
+        self.writer = None
+        if file_format == 'parquet':
+            self.file = None
+        else:
+            self.file = open(path, 'w', newline='')
+            if file_format == 'csv':
+                self.writer = csv.DictWriter(self.file, self.columns)
+                self.writer.writeheader()
+
+    def collect(self, model):
+        state = model.record_state()
+        row = {"day": model.current_day}
+        row.update(aggregate_state(state))
+        if self.file_format == 'jsonl':
+            self.file.write(json.dumps(row) + '\n')
+            self.file.flush()
+        elif self.file_format == 'csv':
+            self.writer.writerow(row)
+            self.file.flush()
+        else:
+            self.rows.append(row)
+            if len(self.rows) >= self.row_group_size:
+                self.flush()
+        self.length += 1
+        return state
+
+    def flush(self):
+        if self.file_format != 'parquet' or not self.rows:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(self.rows)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+        elif self.writer is not None:
+            self.writer.close()
+
+    def __len__(self):
+        return self.length
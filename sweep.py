@@ -0,0 +1,152 @@
+import argparse
+import importlib
+import itertools
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from recorder import AGGREGATES, aggregate_state
+
+# module providing run_model for every engine
+ENGINES = {"mesa": "model", "vectorized": "vectorized", "partitioned": "partitioned"}
+
+
+# Every combination of the grid values repeated `replications` times. Each run gets its own seed
+# spawned from the base seed, so the whole sweep is reproducible from (grid, replications, seed).
+def make_runs(grid, replications=1, seed=0):
+    names = list(grid)
+    combinations = list(itertools.product(*(grid[name] for name in names)))
+    seeds = np.random.SeedSequence(seed).spawn(len(combinations) * replications)
+    runs = []
+    for i, values in enumerate(combinations):
+        for replication in range(replications):
+            run_id = i * replications + replication
+            runs.append({"run_id": run_id,
+                         "replication": replication,
+                         "seed": int(seeds[run_id].generate_state(1)[0]),
+                         "parameters": dict(zip(names, values))})
+    return runs
+
+
+def execute_run(engine, number_of_households, number_of_companies, number_of_steps, fixed, run):
+    row = {"run_id": run["run_id"], "replication": run["replication"], "seed": run["seed"]}
+    row.update(run["parameters"])
+    start = time.time()
+    try:
+        run_model = importlib.import_module(ENGINES[engine]).run_model
+        kwargs = dict(fixed, **run["parameters"])
+        abm_model = run_model(number_of_households, number_of_companies, number_of_steps, seed=run["seed"],
+                              progress=None, **kwargs)
+        row.update(aggregate_state(abm_model.record_state()))
+        row["days"] = abm_model.current_day
+        if abm_model.convergence is not None:
+            row["converged_day"] = abm_model.convergence.converged_day
+        row["error"] = ""
+    except Exception:
+        row["error"] = traceback.format_exc(limit=3)
+    row["seconds"] = time.time() - start
+    return row
+
+
+# execute_run in a process of its own, retried up to `attempts` times if the process dies; a run that
+# crashes every time gets an error row
+def execute_isolated(attempts, *arguments):
+    for _ in range(attempts):
+        try:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                return executor.submit(execute_run, *arguments).result()
+        except BrokenProcessPool:
+            pass
+    run = arguments[-1]
+    row = {"run_id": run["run_id"], "replication": run["replication"], "seed": run["seed"]}
+    row.update(run["parameters"])
+    row["error"] = "worker process crashed"
+    return row
+
+
+def append_row(output, row, columns):
+    header = not os.path.exists(output) or os.path.getsize(output) == 0
+    pd.DataFrame([row], columns=columns).to_csv(output, mode="a", header=header, index=False)
+
+
+# runs with a row and no error; failed runs are run again
+def completed_runs(output):
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return set()
+    rows = pd.read_csv(output, usecols=["run_id", "error"])
+    return set(rows["run_id"][rows["error"].isna() | (rows["error"] == "")])
+
+
+# Runs the grid x seeds in a process pool and appends one row per finished run to the CSV at output.
+# Runs already completed in output are skipped, so an interrupted sweep can be restarted with the same
+# arguments; runs that failed are run again and the last row of every run is returned. If a worker
+# dies, the pool cannot tell which run killed it, so the remaining runs continue in a process each and
+# a run whose process dies max_restarts + 1 times is recorded as crashed.
+def run_sweep(grid, number_of_households, number_of_companies, number_of_steps, output, replications=1, seed=0,
+              engine="mesa", workers=None, fixed=None, max_restarts=3, progress=True):
+    fixed = fixed or {}
+    runs = make_runs(grid, replications, seed)
+    done = completed_runs(output)
+    pending = {run["run_id"]: run for run in runs if run["run_id"] not in done}
+    columns = (["run_id", "replication", "seed"] + list(grid) + list(AGGREGATES) +
+               ["days", "converged_day", "error", "seconds"])
+    bar = tqdm(total=len(runs), initial=len(done), disable=not progress)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(execute_run, engine, number_of_households, number_of_companies,
+                                       number_of_steps, fixed, run) for run in pending.values()]
+            for future in as_completed(futures):
+                row = future.result()
+                append_row(output, row, columns)
+                del pending[row["run_id"]]
+                bar.update()
+    except BrokenProcessPool:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as threads:
+            futures = [threads.submit(execute_isolated, max_restarts + 1, engine, number_of_households,
+                                      number_of_companies, number_of_steps, fixed, run) for run in pending.values()]
+            for future in as_completed(futures):
+                append_row(output, future.result(), columns)
+                bar.update()
+    bar.close()
+    return pd.read_csv(output).drop_duplicates("run_id", keep="last")
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of run_model in a process pool.")
+    parser.add_argument("grid", help="JSON file mapping run_model parameters to lists of values")
+    parser.add_argument("output", help="CSV file the results are appended to")
+    parser.add_argument("--households", type=int, default=150)
+    parser.add_argument("--companies", type=int, default=10)
+    parser.add_argument("--days", type=int, default=20000)
+    parser.add_argument("--replications", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="mesa")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="fixed run_model parameter shared by all runs")
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    fixed = {}
+    for item in args.set:
+        name, value = item.split("=", 1)
+        fixed[name] = parse_value(value)
+    run_sweep(grid, args.households, args.companies, args.days, args.output, args.replications, args.seed,
+              args.engine, args.workers, fixed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import numpy as np
+import checkpoint
+import model
+
+FIELDS = ("price", "hh_wealth", "hh_wage", "company", "companies")
+
+
+# A profiled model pickles its agents as the plain classes; a run continued from its checkpoint is
+# the run continued without one
+def test_profiled_checkpoint_resumes_exactly(tmp_path):
+    abm_model = model.run_model(200, 10, 25, seed=1, progress=None, profile=True, network_density=5)
+    checkpoint.save_checkpoint(abm_model, tmp_path / "profiled.pkl")
+    expected = model.simulate(abm_model, 40, progress=None).datacollector
+    resumed = checkpoint.load_checkpoint(tmp_path / "profiled.pkl")
+    actual = model.simulate(resumed, 40, progress=None).datacollector
+    for name in FIELDS:
+        assert np.array_equal(actual.get_array(name), expected.get_array(name)), name
+    assert resumed.profiler.records
+
+
+# a branch without the network must not keep buying with the social factors cached before the switch
+def test_branch_without_network_drops_cached_social_factors(tmp_path):
+    abm_model = model.run_model(200, 10, 25, seed=1, progress=None, network_density=5)
+    checkpoint.save_checkpoint(abm_model, tmp_path / "network.pkl")
+    branch = checkpoint.load_checkpoint(tmp_path / "network.pkl", use_network=False)
+    assert all(h.social_factors is None and h.ranking is None for h in branch.hh_schedule.agent_buffer())
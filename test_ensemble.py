@@ -0,0 +1,34 @@
+import numpy as np
+import ensemble
+
+
+def summarize(samples, quantiles=ensemble.QUANTILES):
+    accumulator = ensemble.EnsembleAccumulator(1, metrics=("price",), quantiles=quantiles)
+    for x in samples:
+        accumulator.update(0, {"price": x})
+    return accumulator.summary().iloc[0]
+
+
+# P² against np.quantile of the same replicas, in standard deviations of the sample, for a symmetric
+# and a skewed distribution at a typical ensemble size
+def test_p2_quantiles_match_numpy():
+    for draw in (lambda g, n: g.normal(100, 10, n), lambda g, n: g.lognormal(4, 0.5, n)):
+        errors = []
+        for seed in range(20):
+            samples = draw(np.random.default_rng(seed), 200)
+            row = summarize(samples)
+            estimates = [row[f"price_q{p:g}"] for p in ensemble.QUANTILES]
+            errors.append(np.abs(estimates - np.quantile(samples, ensemble.QUANTILES)) / samples.std())
+        errors = np.array(errors)
+        assert np.all(errors.mean(axis=0) < 0.15)
+        assert np.all(errors.max(axis=0) < 0.4)
+
+
+def test_quantiles_need_enough_replicas():
+    samples = np.random.default_rng(0).normal(100, 10, ensemble.MIN_QUANTILE_REPLICAS)
+    row = summarize(samples[:-1])
+    assert row["replications"] == ensemble.MIN_QUANTILE_REPLICAS - 1
+    assert not np.isnan(row["price_mean"])
+    assert all(np.isnan(row[f"price_q{p:g}"]) for p in ensemble.QUANTILES)
+    row = summarize(samples)
+    assert row["price_q0.05"] <= row["price_q0.5"] <= row["price_q0.95"]
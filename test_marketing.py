@@ -0,0 +1,47 @@
+import math
+import tracemalloc
+import numpy as np
+import model
+
+
+def old_marketing_factor(marketing_boost):
+    return max((100 - math.sqrt(marketing_boost)) / 100, 0.6)
+
+
+def test_marketing_factors_match_the_scalar_formula():
+    boosts = np.concatenate([np.linspace(0, 5000, 2001), [1599.9, 1600., 1600.1, 1e6]])
+    expected = [old_marketing_factor(boost) for boost in boosts]
+    assert np.allclose(model.marketing_factors(boosts), expected, rtol=0, atol=1e-12)
+    assert np.all(model.marketing_factors(np.array([1601., 2500., 1e6])) == 0.6)
+
+
+# sizes of the containers at module level in model, where a cache would live
+def module_containers():
+    return {name: len(value) for name, value in vars(model).items()
+            if isinstance(value, (dict, list, set)) and not name.startswith("__")}
+
+
+def test_no_module_level_marketing_cache():
+    assert not hasattr(model, "marketing")
+
+
+# 20000 days of new marketing boosts, which a memo keyed by boost would keep growing with
+def test_effective_prices_use_constant_memory():
+    abm_model = model.run_model(20, 5, 1, seed=1, progress=None, network_density=2)
+    firms = list(abm_model.cmp_schedule.agent_buffer())
+    generator = np.random.default_rng(1)
+    containers = module_containers()
+    tracemalloc.start()
+    try:
+        for day in range(20000):
+            for firm, boost in zip(firms, generator.uniform(0, 3000, len(firms))):
+                firm.marketing_boost = float(boost)
+            abm_model.update_effective_prices()
+            if day == 999:
+                baseline = tracemalloc.get_traced_memory()[0]
+        growth = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    assert growth < 16 * 1024
+    assert module_containers() == containers
+    assert len(abm_model.effective_prices) == len(firms)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import partitioned
+import vectorized
+
+HOUSEHOLDS = 2000
+COMPANIES = 20
+DAYS = 1000
+
+
+def run(engine, seed, **kwargs):
+    abm_model = engine.run_model(HOUSEHOLDS, COMPANIES, DAYS, seed=seed, progress=None, network_density=10, **kwargs)
+    if hasattr(abm_model, "close"):
+        abm_model.close()
+    return abm_model
+
+
+# monthly means over the second half of a run, after the burn-in
+def long_run_means(abm_model):
+    recorder = abm_model.datacollector
+    months = len(recorder.get_array("price"))
+    employed = recorder.get_array("households").sum(axis=1) / HOUSEHOLDS
+    means = {name: recorder.get_array(name)[months // 2:].mean() for name in ("price", "hh_wage", "hh_wealth")}
+    means["employment"] = employed[months // 2:].mean()
+    return means
+
+
+def test_same_seed_and_shards_reproduce_the_run():
+    first = run(partitioned, 3, shards=2).datacollector
+    second = run(partitioned, 3, shards=2).datacollector
+    for name in ("price", "hh_wealth", "company"):
+        assert np.array_equal(first.get_array(name), second.get_array(name))
+
+
+# The partitioned engine splits inventories between shards, so it matches the single-process engine
+# in distribution only: long-run means over a few seeds agree within a few percent
+def test_statistically_equivalent_to_vectorized():
+    seeds = (1, 2)
+    expected = [long_run_means(run(vectorized, seed)) for seed in seeds]
+    for shards in (2, 4):
+        results = [long_run_means(run(partitioned, seed, shards=shards)) for seed in seeds]
+        for name in ("price", "hh_wage", "hh_wealth", "employment"):
+            reference = np.mean([means[name] for means in expected])
+            assert np.mean([means[name] for means in results]) == pytest.approx(reference, rel=0.05), (name, shards)
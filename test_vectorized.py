@@ -0,0 +1,108 @@
+import copy
+import random
+import numpy as np
+import checkpoint
+import model
+import vectorized
+from model import marketing_factors
+
+PURCHASE_STATE = ("hh_wealth", "cmp_wealth", "sold_last_month", "inventory", "demand", "penalty_companies",
+                  "preferred_companies")
+
+
+# buy_goods one household at a time, in activation order, as the householders of model.py buy
+def buy_one_by_one(abm_model, rank):
+    if abm_model.household_parameters.use_marketing:
+        marketing = marketing_factors(abm_model.marketing_boost)
+    else:
+        marketing = np.ones(abm_model.num_cmp)
+    effective_price = (abm_model.price * marketing)[abm_model.companies] * abm_model.social_factor()
+    preference = np.argsort(effective_price, axis=1, kind='stable')
+    for h in np.argsort(rank, kind='stable'):
+        consumption = abm_model.consumption[h]
+        for slot in preference[h]:
+            firm = abm_model.companies[h, slot]
+            total_price = np.trunc(consumption * abm_model.price[firm])
+            abm_model.demand[firm] += consumption
+            if abm_model.inventory[firm] < consumption:
+                abm_model.penalty_companies[h, slot] += 1
+            if abm_model.inventory[firm] > consumption and total_price < abm_model.hh_wealth[h]:
+                abm_model.hh_wealth[h] -= total_price
+                abm_model.cmp_wealth[firm] += total_price
+                abm_model.sold_last_month[firm] += consumption
+                abm_model.inventory[firm] -= consumption
+                abm_model.preferred_companies[h, slot] += 1
+                break
+
+
+def assert_same_purchases(actual, expected):
+    for name in PURCHASE_STATE:
+        assert np.array_equal(getattr(actual, name), getattr(expected, name)), name
+
+
+# random inventories, consumptions and wealth, with some households knowing a firm twice, over more
+# than one PURCHASE_BLOCK of households
+def test_buy_goods_matches_one_by_one_purchases():
+    abm_model = vectorized.run_model(1500, 20, 95, seed=4, progress=None, network_density=10)
+    generator = np.random.default_rng(0)
+    for trial in range(20):
+        state = copy.deepcopy(abm_model)
+        if trial % 2:
+            state.inventory = generator.integers(0, 400, state.num_cmp).astype(float)
+        else:
+            state.inventory = np.floor(state.inventory * generator.random(state.num_cmp))
+        state.consumption = generator.integers(0, 12, state.num_hh).astype(float)
+        state.hh_wealth = np.floor(state.hh_wealth * generator.uniform(0, 0.2, state.num_hh))
+        duplicates = generator.random(state.num_hh) < 0.1
+        state.companies[duplicates, 1] = state.companies[duplicates, 0]
+        expected = copy.deepcopy(state)
+        rank = generator.random(state.num_hh)
+        state.buy_goods(rank)
+        buy_one_by_one(expected, rank)
+        assert_same_purchases(state, expected)
+
+
+# the first household orders more than the inventory, so the second one still gets its order
+def test_buy_goods_leaves_stock_a_household_could_not_take():
+    abm_model = vectorized.run_model(2, 3, 1, seed=1, progress=None, network_density=1)
+    abm_model.companies[:] = [[0, 1, 2], [0, 1, 2]]
+    abm_model.price[:] = [1., 2., 3.]
+    abm_model.inventory[:] = [10., 0., 0.]
+    abm_model.consumption[:] = [12., 5.]
+    abm_model.hh_wealth[:] = 1000
+    abm_model.sold_last_month[:] = 0
+    expected = copy.deepcopy(abm_model)
+    abm_model.buy_goods(np.array([0., 1.]))
+    buy_one_by_one(expected, np.array([0., 1.]))
+    assert_same_purchases(abm_model, expected)
+    assert abm_model.sold_last_month[0] == 5 and abm_model.inventory[0] == 5
+
+
+
+def assert_same_records(actual, expected):
+    for name in actual.shapes:
+        assert np.array_equal(actual.get_array(name), expected.get_array(name)), name
+
+
+# the engine draws from its own generator only, so other users of the global random state do not
+# change a seeded run
+def test_seeded_run_ignores_the_global_random_state():
+    expected = vectorized.run_model(300, 10, 300, seed=5, progress=None, network_density=5)
+    abm_model = vectorized.run_model(300, 10, 0, seed=5, progress=None, network_density=5)
+    for chunk in range(10):
+        random.seed(chunk)
+        np.random.seed(chunk)
+        random.random()
+        np.random.random(1000)
+        model.simulate(abm_model, 30, progress=None)
+    assert_same_records(abm_model.datacollector, expected.datacollector)
+
+
+def test_checkpoint_resumes_exactly(tmp_path):
+    abm_model = vectorized.run_model(300, 10, 150, seed=5, progress=None, network_density=5)
+    checkpoint.save_checkpoint(abm_model, tmp_path / "vectorized.pkl")
+    expected = model.simulate(abm_model, 150, progress=None)
+    np.random.random(1000)
+    resumed = model.simulate(checkpoint.load_checkpoint(tmp_path / "vectorized.pkl"), 150, progress=None)
+    assert resumed.current_day == expected.current_day
+    assert_same_records(resumed.datacollector, expected.datacollector)
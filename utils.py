@@ -1,3 +1,5 @@
+import random
+from collections import deque
 import numpy as np
 
 
@@ -14,3 +16,111 @@ def draw_company(freq_list):
         if value == 1:
             company_id = freq_list[j][0]
     return company_id
+
+
+# Fenwick tree over firm weights (number of employees + 1), used to draw a firm proportionally to
+# its size in O(log F) instead of sorting all firms and drawing a multinomial vector every time
+class FirmSizeIndex:
+    def __init__(self, number_of_firms):
+        self.size = number_of_firms
+        self.weights = [0] * number_of_firms
+        self.tree = [0] * (number_of_firms + 1)
+        for firm_id in range(number_of_firms):
+            self.add(firm_id, 1)
+
+    def add(self, firm_id, delta):
+        self.weights[firm_id] += delta
+        i = firm_id + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        result = 0
+        i = self.size
+        while i > 0:
+            result += self.tree[i]
+            i -= i & -i
+        return result
+
+    def find(self, value):
+        # index of the firm whose cumulative weight range contains value
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if position + step <= self.size and self.tree[position + step] <= value:
+                position += step
+                value -= self.tree[position]
+            step >>= 1
+        return position
+
+    def draw(self, exclude=()):
+        excluded_weights = [(firm_id, self.weights[firm_id]) for firm_id in set(exclude)]
+        for excluded_id, weight in excluded_weights:
+            self.add(excluded_id, -weight)
+        total = self.total()
+        firm_id = None
+        if total > 0:
+            firm_id = min(self.find(np.random.random() * total), self.size - 1)
+        for excluded_id, weight in excluded_weights:
+            self.add(excluded_id, weight)
+        return firm_id
+
+
+# Set with O(1) add, remove and random choice that also remembers in which order items were added,
+# so that the earliest added item can be found in amortized O(1) (firms fire their oldest employee)
+class IndexedSet:
+    def __init__(self, items=()):
+        self.items = []
+        self.positions = {}
+        self.sequence = {}  # item -> number of the add that inserted it
+        self.order = deque()  # (number, item) in insertion order, including removed items
+        self.counter = 0
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item):
+        if item in self.positions:
+            return
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+        self.counter += 1
+        self.sequence[item] = self.counter
+        self.order.append((self.counter, item))
+        if len(self.order) > 2 * len(self.items) + 16:
+            self.order = deque(entry for entry in self.order if self.sequence.get(entry[1]) == entry[0])
+
+    def remove(self, item):
+        position = self.positions.pop(item)
+        del self.sequence[item]
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def discard(self, item):
+        if item in self.positions:
+            self.remove(item)
+
+    def choice(self):
+        return self.items[int(random.random() * len(self.items))]
+
+    def first(self):
+        while self.order:
+            number, item = self.order[0]
+            if self.sequence.get(item) == number:
+                return item
+            self.order.popleft()
+        raise IndexError('first() of an empty IndexedSet')
+
+    def ordered(self):
+        return [item for number, item in self.order if self.sequence.get(item) == number]
@@ -0,0 +1,462 @@
+import inspect
+import numpy as np
+from model import run_model as run_mesa_model, marketing_factors, RUNTIME_HOUSEHOLD_PARAMETERS, \
+    RUNTIME_COMPANY_PARAMETERS
+from recorder import ArrayRecorder
+from profiling import PhaseProfiler, NULL_PHASE
+from convergence import make_monitor
+from network import load_network, spawn_seeds
+
+# number of type A connections every householder starts with
+KNOWN_FIRMS = 3
+# number of households whose purchases are resolved together. Blocks follow each other in activation
+# order; contention inside a block takes a few passes over its arrays, more in larger blocks
+PURCHASE_BLOCK = 1024
+# rows of LenVectorized.month_draws after the activation orders of the ten days of the month
+SEARCH_PRODUCTIVE, PRODUCTIVE_SLOT, SEARCH_PRICE, PRICE_SLOT, SEARCH_NETWORK, NETWORK_SLOT = range(10, 16)
+
+
+# Struct-of-arrays version of LenExtended. Every phase of Company.step and Householder.step is
+# applied to all agents at once. Households competing for the same inventory or vacancy are served
+# in the daily activation order, so runs are statistically equivalent to LenExtended, not identical.
+# All randomness comes from one numpy Generator per model, so a seeded run is reproducible bit for
+# bit whatever else uses the global random state.
+class LenVectorized:
+
+    def __init__(self, num_hh, num_cmp, household_parameters, company_parameters, network_density,
+                 datacollector=None, seed=None, profile=False, convergence=None, network=None):
+        self.rng = np.random.default_rng(spawn_seeds(seed)[0])
+        self.month_draws = None
+        self.num_hh = num_hh
+        self.num_cmp = num_cmp
+        self.current_day = 0
+        self.running = True
+        self.household_parameters = household_parameters
+        self.company_parameters = company_parameters
+        self.init_companies()
+        self.init_households()
+
+        # Social network as CSR adjacency
+        self.social_network = network if network is not None else load_network(num_hh, network_density, seed)
+
+        self.datacollector = datacollector if datacollector is not None else ArrayRecorder()
+        self.convergence = make_monitor(convergence)
+        self.profiler = PhaseProfiler() if profile else None
+
+    def init_companies(self):
+        cp = self.company_parameters
+        num_cmp = self.num_cmp
+        self.cmp_wealth = self.rng.integers(cp.company_min_wealth, cp.company_max_wealth + 1, num_cmp).astype(float)
+        self.cmp_wage = self.rng.integers(cp.company_min_wage, cp.company_max_wage + 1, num_cmp).astype(float)
+        self.price = cp.initial_price + self.rng.integers(cp.min_random_price, cp.max_random_price + 1,
+                                                          num_cmp).astype(float)
+        self.looking_for_worker = np.zeros(num_cmp, dtype=bool)
+        self.full_workplaces = np.zeros(num_cmp, dtype=np.int64)
+        self.workers_in_previous_month = np.zeros(num_cmp, dtype=np.int64)
+        self.demand = np.full(num_cmp, cp.demand, dtype=float)
+        self.inventory = np.full(num_cmp, cp.inventory, dtype=float)
+        self.marketing_investments = np.full(num_cmp, cp.marketing_investments, dtype=float)
+        self.marketing_boost = np.zeros(num_cmp)
+        self.sold_last_month = np.full(num_cmp, 10, dtype=float)
+
+    def init_households(self):
+        hp = self.household_parameters
+        num_hh, num_cmp = self.num_hh, self.num_cmp
+        if num_cmp < KNOWN_FIRMS:
+            raise ValueError(f"every householder knows {KNOWN_FIRMS} firms, got {num_cmp} firms")
+        self.hh_wealth = self.rng.integers(hp.min_wealth, hp.max_wealth + 1, num_hh).astype(float)
+        self.hh_wage = np.full(num_hh, hp.default_wage, dtype=float)
+        self.consumption = np.full(num_hh, hp.default_consumption, dtype=float)
+        # ids of firms where householder can buy goods (type A connection)
+        self.companies = self.rng.integers(0, num_cmp, (num_hh, KNOWN_FIRMS))
+        while True:
+            known = np.sort(self.companies, axis=1)
+            repeated = np.flatnonzero((known[:, 1:] == known[:, :-1]).any(axis=1))
+            if len(repeated) == 0:
+                break
+            self.companies[repeated] = self.rng.integers(0, num_cmp, (len(repeated), KNOWN_FIRMS))
+        # id of the employer, -1 if unemployed
+        self.company = self.rng.integers(0, num_cmp, num_hh)
+        # hiring order, firms fire the employee that was hired first
+        self.hired_at = np.arange(num_hh, dtype=np.int64)
+        self.hires = num_hh
+        self.penalty_companies = np.zeros((num_hh, KNOWN_FIRMS), dtype=np.int64)
+        self.preferred_companies = np.zeros((num_hh, KNOWN_FIRMS), dtype=np.int64)
+        self.most_preferred = np.full(num_hh, -1, dtype=np.int64)
+        self.most_preferred_count = np.zeros(num_hh)
+        # social influence of every (household, firm) pair with non-zero influence, sorted by key
+        # household * num_cmp + firm
+        self.influence_keys = np.zeros(0, dtype=np.int64)
+        self.influence_values = np.zeros(0)
+        self.most_influenced = np.full(num_hh, -1, dtype=np.int64)
+
+    # Random numbers every household needs in a month, drawn at once at its start: the activation
+    # order of every day (lower first) and the monthly searches
+    def draw_month(self):
+        self.month_draws = self.rng.random((16, self.num_hh))
+
+    # New random stream, e.g. for a branch of a checkpoint; the rest of the current month is redrawn
+    def reseed(self, seed):
+        self.rng = np.random.default_rng(spawn_seeds(seed)[0])
+        self.month_draws = None
+
+    def phase(self, name):
+        if self.profiler is None:
+            return NULL_PHASE
+        return self.profiler.phase(name)
+
+    def record_state(self):
+        cp = self.company_parameters
+        return {"hh_wealth": self.hh_wealth,
+                "hh_wage": self.hh_wage,
+                "consumption": self.consumption,
+                "companies": self.companies,
+                "company": self.company,
+                "C_wealth": self.cmp_wealth,
+                "C_wage": self.cmp_wage,
+                "price": self.price,
+                "looking_for_worker": self.looking_for_worker,
+                "demand": self.demand,
+                "inventory": self.inventory,
+                "gamma": np.full(self.num_cmp, cp.gamma, dtype=float),
+                "lambda_coefficient": np.full(self.num_cmp, cp.lambda_coefficient, dtype=float),
+                "households": self.employees(),
+                "marketing_investments": self.marketing_investments,
+                "marketing_boost": self.marketing_boost}
+
+    def set_parameters(self, **parameters):
+        for name, value in parameters.items():
+            if name not in RUNTIME_HOUSEHOLD_PARAMETERS and name not in RUNTIME_COMPANY_PARAMETERS:
+                raise ValueError(f'{name} cannot be changed after the model is created')
+            if name in RUNTIME_HOUSEHOLD_PARAMETERS:
+                setattr(self.household_parameters, name, value)
+            if name in RUNTIME_COMPANY_PARAMETERS:
+                setattr(self.company_parameters, name, value)
+            if name == "demand_min":
+                self.company_parameters.start_marketing = value * 1.5
+            if name == "marketing_investments":
+                self.marketing_investments[:] = value
+
+    def employees(self):
+        employed = self.company[self.company >= 0]
+        return np.bincount(employed, minlength=self.num_cmp)
+
+    # Company phases
+
+    def companies_step(self):
+        cp = self.company_parameters
+        households = self.employees()
+        self.marketing_boost += households * self.marketing_investments * 100
+        if cp.use_marketing:
+            self.inventory += households * cp.lambda_coefficient * (1 - self.marketing_investments)
+        else:
+            self.inventory += households * cp.lambda_coefficient
+        if self.current_day % 10 == 0:
+            with self.phase("companies_end_of_month"):
+                self.companies_end_of_month()
+
+    def companies_end_of_month(self):
+        cp = self.company_parameters
+        num_cmp = self.num_cmp
+
+        # change_marketing_investments
+        threshold = cp.start_marketing * self.sold_last_month
+        more = (self.inventory > threshold) & (self.marketing_investments < 0.5)
+        less = ~more & (self.inventory < threshold * 0.5) & (self.marketing_investments > 0.01)
+        self.marketing_investments[more] += 0.03
+        self.marketing_investments[less] -= 0.01
+
+        # invest_in_marketing
+        self.marketing_boost *= 0.8
+
+        # pay_wages
+        households = self.employees()
+        employed = self.company >= 0
+        employers = self.company[employed]
+        staffed = households > 0
+        broke = staffed & (households * self.cmp_wage > self.cmp_wealth)
+        self.cmp_wage[broke] = np.trunc(self.cmp_wealth[broke] / households[broke])
+        self.hh_wealth[employed] += self.cmp_wage[employers]
+        self.cmp_wealth -= households * self.cmp_wage
+        self.hh_wage[employed] = np.maximum(self.hh_wage[employed], self.cmp_wage[employers])
+
+        # share_liquidity
+        buffer = self.cmp_wage * households * cp.money_buffer_coefficient
+        liquidity = np.zeros(num_cmp)
+        liquidity[staffed] = np.trunc((self.cmp_wealth[staffed] - buffer[staffed]) / households[staffed])
+        liquidity[liquidity < 0] = 0
+        self.cmp_wage += liquidity
+        self.hh_wealth[employed] += liquidity[employers]
+        self.hh_wage[employed] += liquidity[employers]
+        self.cmp_wealth -= liquidity * households
+
+        # count_workers
+        kept = households >= self.workers_in_previous_month
+        self.full_workplaces = np.where(kept, self.full_workplaces + 1, 0)
+        self.workers_in_previous_month = households
+
+        # set_wage_rate
+        raise_wage = self.looking_for_worker
+        self.cmp_wage[raise_wage] *= 1 + self.rng.uniform(0, cp.sigma, raise_wage.sum())
+        cut_wage = self.full_workplaces > cp.gamma
+        self.cmp_wage[cut_wage] *= 1 - self.rng.uniform(0, cp.sigma, cut_wage.sum())
+
+        # hire_or_fire
+        self.looking_for_worker = self.inventory <= cp.demand_min * self.sold_last_month
+        fire = (self.inventory > cp.demand_max * self.sold_last_month) & staffed
+        if fire.any():
+            candidates = np.flatnonzero(employed & fire[np.maximum(self.company, 0)])
+            order = np.lexsort((self.hired_at[candidates], self.company[candidates]))
+            candidates = candidates[order]
+            first = np.concatenate([[True], self.company[candidates][1:] != self.company[candidates][:-1]])
+            self.company[candidates[first]] = -1
+        self.demand[:] = 0
+        self.sold_last_month[:] = 0
+
+        # change_goods_price
+        marginal_costs = self.cmp_wage / (10 * cp.lambda_coefficient)
+        increase = (self.price < cp.phi_min * marginal_costs) & (self.rng.random(num_cmp) < cp.tau)
+        self.price[increase] *= 1 + self.rng.uniform(0, cp.upsilon, increase.sum())
+        decrease = (self.price > cp.phi_max * marginal_costs) & (self.rng.random(num_cmp) < cp.tau)
+        self.price[decrease] *= 1 - self.rng.uniform(0, cp.upsilon, decrease.sum())
+
+    # Household phases
+
+    # Vectorized add_firm_by_households: a firm for every household in rows, drawn with weight
+    # (employees + 1) among firms the household does not know yet
+    def draw_firm_by_households(self, rows):
+        weights = self.employees() + 1.
+        cumulative = np.cumsum(weights)
+        drawn = np.empty(len(rows), dtype=np.int64)
+        pending = np.arange(len(rows))
+        for _ in range(20):
+            if len(pending) == 0:
+                return drawn
+            picks = np.searchsorted(cumulative, self.rng.random(len(pending)) * cumulative[-1], side='right')
+            picks = np.minimum(picks, self.num_cmp - 1)
+            drawn[pending] = picks
+            known = (self.companies[rows[pending]] == picks[:, None]).any(axis=1)
+            pending = pending[known]
+        for i in pending:
+            available = np.setdiff1d(np.arange(self.num_cmp), self.companies[rows[i]])
+            p = weights[available] / weights[available].sum()
+            drawn[i] = available[np.searchsorted(np.cumsum(p), self.rng.random(), side='right').clip(
+                max=len(available) - 1)]
+        return drawn
+
+    def calculate_most_preferred(self):
+        best = np.argmax(self.preferred_companies, axis=1)
+        rows = np.arange(self.num_hh)
+        self.most_preferred[:] = self.companies[rows, best]
+        self.most_preferred_count[:] = self.preferred_companies[rows, best]
+
+    def search_productive_firms(self):
+        hp = self.household_parameters
+        rows = np.flatnonzero(self.month_draws[SEARCH_PRODUCTIVE] < hp.prob_search_prod)
+        if len(rows) == 0:
+            return
+        weights = self.penalty_companies[rows] + 1.
+        cumulative = np.cumsum(weights, axis=1)
+        u = self.month_draws[PRODUCTIVE_SLOT, rows] * cumulative[:, -1]
+        slots = (cumulative <= u[:, None]).sum(axis=1).clip(max=KNOWN_FIRMS - 1)
+        self.companies[rows, slots] = self.draw_firm_by_households(rows)
+
+    def search_cheaper_prices(self):
+        hp = self.household_parameters
+        rows = np.flatnonzero(self.month_draws[SEARCH_PRICE] < hp.prob_search_price)
+        if len(rows) == 0:
+            return
+        slots = (self.month_draws[PRICE_SLOT, rows] * KNOWN_FIRMS).astype(np.int64)
+        candidates = self.draw_firm_by_households(rows)
+        cheaper = self.price[candidates] / self.price[self.companies[rows, slots]] < hp.critical_price_ratio
+        self.companies[rows[cheaper], slots[cheaper]] = candidates[cheaper]
+
+    def get_new_company_from_network(self):
+        hp = self.household_parameters
+        searching = self.month_draws[SEARCH_NETWORK] < hp.prob_search_prod
+        rows = np.flatnonzero(searching & (self.most_influenced >= 0))
+        slots = (self.month_draws[NETWORK_SLOT, rows] * KNOWN_FIRMS).astype(np.int64)
+        self.companies[rows, slots] = self.most_influenced[rows]
+
+    # One search_new_job attempt of the active householders: returns the rows and firms of those who
+    # apply at a firm looking for a worker
+    def job_applications(self, active):
+        hp = self.household_parameters
+        rows = np.flatnonzero(active)
+        probes = self.rng.integers(0, self.num_cmp, len(rows))
+        hit = self.looking_for_worker[probes]
+        rows, probes = rows[hit], probes[hit]
+        current = self.company[rows]
+        employed = current >= 0
+        current_wage = self.cmp_wage[np.maximum(current, 0)]
+        better = self.cmp_wage[probes] > current_wage
+        satisfied = current_wage >= self.hh_wage[rows]
+        switch = employed & better & (~satisfied | (self.rng.random(len(rows)) < hp.search_job_chance))
+        hire = ~employed & (self.cmp_wage[probes] >= self.hh_wage[rows])
+        # employed householders stop searching at the first firm looking for a worker
+        active[rows[employed & ~switch]] = False
+        applicants = switch | hire
+        return rows[applicants], probes[applicants]
+
+    def search_new_job(self, rank):
+        hp = self.household_parameters
+        active = np.ones(self.num_hh, dtype=bool)
+        for _ in range(hp.unemployed_attempts):
+            if not active.any():
+                break
+            rows, probes = self.job_applications(active)
+            # each vacancy goes to the applicant who is activated first
+            order = np.lexsort((rank[rows], probes))
+            rows, probes = rows[order], probes[order]
+            winners = np.concatenate([[True], probes[1:] != probes[:-1]]) if len(rows) else np.zeros(0, bool)
+            rows, probes = rows[winners], probes[winners]
+            self.company[rows] = probes
+            self.hired_at[rows] = self.hires + np.arange(len(rows))
+            self.hires += len(rows)
+            self.hh_wage[rows] = self.cmp_wage[probes]
+            self.looking_for_worker[probes] = False
+            active[rows] = False
+        self.hh_wage[active] *= hp.wage_decreasing_coefficient
+
+    def identify_consumption(self):
+        average_price = self.price[self.companies].mean(axis=1)
+        self.consumption = np.trunc((self.hh_wealth / (10 * average_price)) ** self.household_parameters.consumption_power)
+
+    # most_preferred and its number of purchases for the given households
+    def preferred_of(self, households):
+        return self.most_preferred[households], self.most_preferred_count[households]
+
+    def calculate_social_influence(self):
+        neighbors, degree = self.social_network.indices, self.social_network.degree
+        sources = np.repeat(np.arange(self.num_hh), degree)
+        firms, counts = self.preferred_of(neighbors)
+        valid = (firms >= 0) & (counts != 0)
+        sources, firms = sources[valid], firms[valid]
+        weights = counts[valid] / degree[sources]
+        keys, inverse = np.unique(sources * self.num_cmp + firms, return_inverse=True)
+        values = np.bincount(inverse, weights=weights, minlength=len(keys))
+        self.influence_keys, self.influence_values = keys, values
+        self.most_influenced = np.full(self.num_hh, -1, dtype=np.int64)
+        if len(keys):
+            households = keys // self.num_cmp
+            order = np.lexsort((-values, households))
+            first = np.concatenate([[True], households[order][1:] != households[order][:-1]])
+            self.most_influenced[households[order][first]] = (keys % self.num_cmp)[order][first]
+
+    def households_end_of_month(self, rank):
+        with self.phase("calculate_most_preferred"):
+            self.calculate_most_preferred()
+        with self.phase("search_productive_firms"):
+            self.search_productive_firms()
+        with self.phase("search_cheaper_prices"):
+            self.search_cheaper_prices()
+        with self.phase("get_new_company_from_network"):
+            self.get_new_company_from_network()
+        with self.phase("search_new_job"):
+            self.search_new_job(rank)
+        with self.phase("identify_consumption"):
+            self.identify_consumption()
+        with self.phase("social_influence"):
+            self.calculate_social_influence()
+        self.penalty_companies[:] = 0
+        self.preferred_companies[:] = 0
+
+    def social_factor(self):
+        factor = np.ones(self.companies.shape)
+        if not self.household_parameters.use_network or len(self.influence_keys) == 0:
+            return factor
+        keys = np.arange(self.num_hh)[:, None] * self.num_cmp + self.companies
+        positions = np.searchsorted(self.influence_keys, keys).clip(max=len(self.influence_keys) - 1)
+        found = self.influence_keys[positions] == keys
+        influence = self.influence_values[positions]
+        factor[found] = np.maximum(1 - np.sqrt(influence[found]) * 0.01, 0.95)
+        return factor
+
+    def buy_goods(self, rank):
+        if self.household_parameters.use_marketing:
+            marketing = marketing_factors(self.marketing_boost)
+        else:
+            marketing = np.ones(self.num_cmp)
+        effective_price = (self.price * marketing)[self.companies] * self.social_factor()
+        preference = np.argsort(effective_price, axis=1, kind='stable')
+        activation = np.argsort(rank, kind='stable')
+        for start in range(0, self.num_hh, PURCHASE_BLOCK):
+            self.buy_in_order(activation[start:start + PURCHASE_BLOCK], preference)
+
+    # Purchases of the households in rows, in this activation order, as if they bought one after the
+    # other: every household buys at the first firm in its preference order that has more than its
+    # consumption left after the purchases of the households before it, and that it can afford.
+    def buy_in_order(self, rows, preference):
+        preference = preference[rows]
+        firms = self.companies[rows[:, None], preference]  # known firms in order of preference
+        consumption = self.consumption[rows, None]
+        total_price = np.trunc(consumption * self.price[firms])
+        affordable = total_price < self.hh_wealth[rows, None]
+        # all visits sorted by firm, then activation order, and the first visit of their firm
+        order = np.argsort((firms * len(rows) + np.arange(len(rows))[:, None]).ravel(), kind='stable')
+        visitors, visits = np.divmod(order, KNOWN_FIRMS)
+        visited_firms = firms.ravel()[order]
+        group_start = np.concatenate([[True], visited_firms[1:] != visited_firms[:-1]])
+        first_visit = np.maximum.accumulate(np.where(group_start, np.arange(len(order)), 0))
+        sold_before = np.empty(firms.shape)
+        inventory = self.inventory[firms]
+
+        # choice is the index of the firm each household buys at (KNOWN_FIRMS if none). It is
+        # recomputed from the purchases of the previous pass until it no longer changes: after pass j
+        # it is right for the first j households, so the result is the sequential one.
+        choice = np.full(len(rows), KNOWN_FIRMS)
+        while True:
+            taken = np.where(choice[visitors] == visits, consumption[visitors, 0], 0)
+            before = np.cumsum(taken) - taken
+            sold_before.ravel()[order] = before - before[first_visit]
+            inventory_left = inventory - sold_before
+            available = (inventory_left > consumption) & affordable
+            new_choice = np.where(available.any(axis=1), available.argmax(axis=1), KNOWN_FIRMS)
+            if np.array_equal(new_choice, choice):
+                break
+            choice = new_choice
+
+        # households visit their firms up to the one they buy at
+        visited = np.arange(KNOWN_FIRMS) <= choice[:, None]
+        self.demand += np.bincount(firms[visited], weights=np.broadcast_to(consumption, firms.shape)[visited],
+                                   minlength=self.num_cmp)
+        short = visited & (inventory_left < consumption)
+        self.penalty_companies[rows[np.nonzero(short)[0]], preference[short]] += 1
+        buyers = np.flatnonzero(choice < KNOWN_FIRMS)
+        slots, firms = preference[buyers, choice[buyers]], firms[buyers, choice[buyers]]
+        consumption, total_price = consumption[buyers, 0], total_price[buyers, choice[buyers]]
+        rows = rows[buyers]
+        self.hh_wealth[rows] -= total_price
+        self.cmp_wealth += np.bincount(firms, weights=total_price, minlength=self.num_cmp)
+        sold = np.bincount(firms, weights=consumption, minlength=self.num_cmp)
+        self.sold_last_month += sold
+        self.inventory -= sold
+        self.preferred_companies[rows, slots] += 1
+
+    def step(self):
+        with self.phase("companies"):
+            self.companies_step()
+        if self.current_day % 10 == 0 or self.month_draws is None:
+            self.draw_month()
+        rank = self.month_draws[self.current_day % 10]
+        if self.current_day % 10 == 0:
+            with self.phase("households_end_of_month"):
+                self.households_end_of_month(rank)
+        with self.phase("buy_goods"):
+            self.buy_goods(rank)
+        if self.current_day % 10 == 0:
+            with self.phase("collect"):
+                if self.convergence is None:
+                    self.datacollector.collect(self)
+                else:
+                    self.convergence.collect(self)
+
+        self.current_day += 1
+
+
+def run_model(*args, **kwargs):
+    return run_mesa_model(*args, model_cls=LenVectorized, **kwargs)
+
+
+# same arguments as model.run_model, for the callers that read the signature (cli, cache)
+run_model.__signature__ = inspect.signature(run_mesa_model)